@@ -20,6 +20,15 @@ logger = get_logger("gen3utils", log_level="info")
 
 CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
 
+# click's defaults, and the same with a UTC offset like +02:00 or Z
+TIME_FORMATS = [
+    "%Y-%m-%d",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%dT%H:%M:%S%z",
+    "%Y-%m-%d %H:%M:%S%z",
+]
+
 
 @click.group()
 def main():
@@ -159,15 +168,258 @@ def post_deployment_changes(repository, pull_request_number):
     show_default=True,
 )
 @click.option(
+    "--local",
+    is_flag=True,
+    help="Read the logs from disk instead of S3: BUCKET is a directory, whose "
+    "files under PREFIX are processed, or a glob pattern like 'logs/**/*.gz'.",
+)
+@click.option(
+    "--inventory",
+    help="s3:// URL of the manifest.json of an S3 Inventory report (CSV, or "
+    "Parquet with pyarrow installed) of BUCKET, listing the keys under PREFIX "
+    "from it instead of from S3.",
+)
+@click.option(
+    "-w",
+    "--workers",
     "-c",
     "--concurrency",
+    "workers",
     type=int,
     default=multiprocessing.cpu_count() + 1,
     show_default=True,
+    help="Number of worker processes parsing logs and running SCRIPT. 0 runs "
+    "SCRIPT in this process instead.",
+)
+@click.option(
+    "-f",
+    "--fetchers",
+    type=int,
+    default=2 * (multiprocessing.cpu_count() + 1),
+    show_default=True,
+    help="Number of concurrent S3 downloads.",
+)
+@click.option(
+    "--listers",
+    type=int,
+    default=8,
+    show_default=True,
+    help="Number of concurrent S3 listing requests.",
+)
+@click.option(
+    "--list-depth",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Discover sub-prefixes (e.g. date partitions) this many '/' levels "
+    "below PREFIX and list them in parallel.",
+)
+@click.option(
+    "--buffer",
+    type=click.IntRange(min=1),
+    default=512,
+    show_default=True,
+    help="Maximum MiB of downloaded data waiting for a worker.",
+)
+@click.option(
+    "--split-size",
+    type=int,
+    default=0,
+    show_default=True,
+    help="Split newline-delimited objects larger than this many MiB into "
+    "ranges of this size, processed in parallel. 0 disables splitting.",
+)
+@click.option(
+    "--checkpoint",
+    type=click.Path(dir_okay=False),
+    help="SQLite file recording processed keys. Keys already recorded with the "
+    "same ETag by the same SCRIPT and options are skipped, so an interrupted "
+    "run can be resumed.",
+)
+@click.option(
+    "--cache",
+    type=click.Path(dir_okay=False),
+    help="SQLite file caching the output or partial aggregate of each log by "
+    "ETag and SCRIPT. Logs unchanged since a run of the same SCRIPT with the "
+    "same options are not fetched again.",
+)
+@click.option(
+    "--cache-size",
+    type=int,
+    default=1024,
+    show_default=True,
+    help="MiB of results kept in --cache, evicting the least recently used.",
+)
+@click.option(
+    "--object-cache",
+    type=click.Path(file_okay=False),
+    help="Directory keeping the logs fetched from S3 by key and ETag, so runs "
+    "of any SCRIPT over the same logs read them from disk instead. Ranges of "
+    "objects split by --split-size are not cached.",
+)
+@click.option(
+    "--object-cache-size",
+    type=int,
+    default=10240,
+    show_default=True,
+    help="MiB of logs kept in --object-cache, evicting the least recently used.",
+)
+@click.option(
+    "--output",
+    type=click.Path(file_okay=False),
+    help="Directory where workers write SCRIPT output as shards, listed in a "
+    "manifest.json at the end, instead of printing it.",
+)
+@click.option(
+    "--output-format",
+    type=click.Choice(["ndjson", "parquet"]),
+    default="ndjson",
+    show_default=True,
+    help="Format of the --output shards. Strings are written as is to NDJSON, "
+    "other values as JSON. Parquet needs pyarrow.",
+)
+@click.option(
+    "--output-compression",
+    type=click.Choice(["none", "gzip", "zstd"]),
+    default="none",
+    show_default=True,
+    help="Compression of the --output shards.",
+)
+@click.option(
+    "--since",
+    type=click.DateTime(TIME_FORMATS),
+    help="Only process logs from this time on (UTC unless an offset is given).",
+)
+@click.option(
+    "--until",
+    type=click.DateTime(TIME_FORMATS),
+    help="Only process logs before this time (UTC unless an offset is given).",
+)
+@click.option(
+    "--key-time",
+    help="Regular expression with year/month/day/hour/minute named groups "
+    "reading the time of a key from its name, to skip keys outside "
+    "--since/--until before fetching them. Defaults to date partitions like "
+    "2024/01/31, 2024-01-31 or 2024/01/31/23.",
+)
+@click.option(
+    "--row-time",
+    help="Field of each row holding its timestamp (ISO 8601 or epoch seconds, "
+    "dots for nested fields). Rows outside --since/--until are skipped before "
+    "calling the script.",
+)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=4096,
+    show_default=True,
+    help="Number of rows passed to each handle_batch(rows) call, for scripts "
+    "defining it.",
+)
+@click.option(
+    "--decoder",
+    type=click.Choice(["auto", "json", "orjson", "msgspec"]),
+    default="auto",
+    show_default=True,
+    help="JSON parser for newline-delimited logs. auto uses orjson or msgspec "
+    "when installed, msgspec first if SCRIPT declares FIELDS, json the "
+    "standard library one. Records they reject are "
+    "parsed by the standard library.",
+)
+@click.option(
+    "--pool",
+    type=click.Choice(["forkserver", "subprocess"]),
+    default="forkserver",
+    show_default=True,
+    help="How worker processes start: forked from a server process that "
+    "imported SCRIPT once, or each as a new Python interpreter. Workers that "
+    "die are restarted either way.",
+)
+@click.option(
+    "--transport",
+    type=click.Choice(["pipe", "shm"]),
+    default="pipe",
+    show_default=True,
+    help="How logs reach worker processes: written to their stdin pipe, or "
+    "copied to a shared memory ring per worker with only chunk sizes going "
+    "through the pipe, which leaves this process more time to fetch.",
+)
+@click.option(
+    "--order",
+    type=click.Choice(["listing", "largest-first"]),
+    default="listing",
+    show_default=True,
+    help="Order to fetch logs in. largest-first picks the largest among up to "
+    "10000 listed keys, so a large log listed last does not delay the end.",
+)
+@click.option(
+    "--in-process-below",
+    type=int,
+    default=4,
+    show_default=True,
+    help="Run SCRIPT in this process, without starting workers, when the "
+    "listed logs add up to no more than this many MiB. 0 disables it, as "
+    "does --follow.",
+)
+@click.option(
+    "--metrics",
+    help="Expose counters and gauges of the run in the Prometheus text format "
+    "at http://HOST:PORT/metrics for a PORT or HOST:PORT value (HOST defaults "
+    "to 127.0.0.1), or append them every second as JSON lines to this file.",
+)
+@click.option(
+    "--shard",
+    help="Only process shard i/N of the logs (0 <= i < N), to split a run "
+    "between N machines or processes listing the same logs.",
+)
+@click.option(
+    "--shard-by",
+    type=click.Choice(["hash", "size"]),
+    default="hash",
+    show_default=True,
+    help="How keys are assigned to --shard: by a stable hash of the key, or "
+    "balancing the total size of the shards, which lists all the logs before "
+    "processing any and cannot be used with --follow.",
+)
+@click.option(
+    "--partial",
+    help="Also save the aggregate of the run to this file, for s3log-merge "
+    "to combine with the ones of the other shards.",
+)
+@click.option(
+    "--follow",
+    is_flag=True,
+    help="Keep running with the same workers, listing the logs after the last "
+    "key seen every --poll-interval seconds. Aggregates are printed for each "
+    "poll that processed logs. With --checkpoint, the last key is kept there "
+    "to resume after it.",
+)
+@click.option(
+    "--poll-interval",
+    type=float,
+    default=60,
+    show_default=True,
+    help="Seconds between listings with --follow.",
+)
+@click.option(
+    "--plan-only",
+    is_flag=True,
+    help="Only list the logs that would be processed, taking --checkpoint and "
+    "--since/--until into account, and print their count, total size and an "
+    "estimated runtime at --plan-throughput.",
+)
+@click.option(
+    "--plan-throughput",
+    type=float,
+    default=50,
+    show_default=True,
+    help="MiB/s of logs assumed to be processed for the --plan-only estimate. "
+    "The AVG speed of a previous run on the same logs is a good value.",
 )
 @click.option("--progress/--no-progress", default=True, show_default=True)
 def s3log(*args, **kwargs):
-    """Run SCRIPT in Gen3 logs under S3 BUCKET:PREFIX.
+    """Run SCRIPT in Gen3 logs under S3 BUCKET:PREFIX, or in a local
+    directory with --local.
 
     The SCRIPT should be importable defining a method like this:
 
@@ -177,6 +429,19 @@ def s3log(*args, **kwargs):
                 return line
 
     The returning results will be joined with newline into the stdout.
+
+    To aggregate instead, also define init(), merge(a, b) and optionally
+    finalize(aggregate). handle_row(obj, line, aggregate) then updates the
+    aggregate (or returns a new one), and the merged, finalized result of
+    all workers is printed once at the end.
+
+    To process rows in bulk, define handle_batch(rows) instead, returning the
+    results to print. With BATCH_FIELDS = ["field", "nested.field"] it gets a
+    dict of field -> list of values instead of the rows.
+
+    Declaring PREFILTER = b"text" (or a compiled bytes regex) skips records
+    not matching it before they are decoded, and FIELDS = ["field",
+    "nested.field"] reduces rows to these fields.
     """
     try:
         from gen3utils.s3log.s3log import S3Log
@@ -184,7 +449,27 @@ def s3log(*args, **kwargs):
         print(e, '\nInstall with `poetry install --extras "s3log"` to run this command')
         exit(1)
 
-    S3Log(*args, **kwargs).run()
+    if S3Log(*args, **kwargs).run():
+        exit(1)
+
+
+@main.command("s3log-merge")
+@click.argument("paths", nargs=-1, required=True)
+@click.option(
+    "--script",
+    help="SCRIPT of the runs, whose merge(a, b) and finalize(aggregate) "
+    "combine --partial files.",
+)
+def s3log_merge(paths, script):
+    """Combine the results of s3log runs over shards of the same logs.
+
+    PATHS are either the --partial files of the runs, whose aggregates are
+    merged with SCRIPT and printed, or their --output directories, whose
+    shards are listed in one manifest printed as JSON.
+    """
+    from gen3utils.s3log.merge import merge
+
+    merge(script, paths)
 
 
 if __name__ == "__main__":
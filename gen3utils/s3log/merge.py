@@ -0,0 +1,77 @@
+"""
+Combine the results of s3log runs over the shards of the same logs (see
+``--shard``): the ``--partial`` aggregates into one result, and the
+``--output`` directories into one manifest.
+"""
+
+import functools
+import importlib
+import json
+import os
+import pickle
+
+
+def merge_partials(script, paths):
+    """
+    Aggregate of the pickled ``--partial`` files, merged with the ``merge(a,
+    b)`` of ``script`` and finalized like at the end of a run.
+    """
+    module = importlib.import_module(script)
+    init = getattr(module, "init", None)
+    merge = getattr(module, "merge", None)
+    if init is None or merge is None:
+        raise ValueError(f"{script} must define init() and merge(a, b)")
+    partials = []
+    for path in paths:
+        with open(path, "rb") as f:
+            partials.append(pickle.load(f))
+    result = functools.reduce(merge, partials, init())
+    finalize = getattr(module, "finalize", None)
+    return finalize(result) if finalize is not None else result
+
+
+def merge_manifests(directories):
+    """
+    Manifest listing the shards of all the ``--output`` directories, with
+    paths relative to the current directory, and their total counts.
+    """
+    manifests = []
+    for directory in directories:
+        with open(os.path.join(directory, "manifest.json")) as f:
+            manifests.append((directory, json.load(f)))
+    kinds = {(m["format"], m["compression"]) for _, m in manifests}
+    if len(kinds) > 1:
+        raise ValueError(
+            "Outputs have different formats or compressions: "
+            + ", ".join(f"{f}/{c}" for f, c in sorted(kinds, key=str))
+        )
+    first = manifests[0][1]
+    return {
+        "format": first["format"],
+        "compression": first["compression"],
+        "objects": sum(m["objects"] for _, m in manifests),
+        "lines": sum(m["lines"] for _, m in manifests),
+        "shards": [
+            {**shard, "path": os.path.join(directory, shard["path"])}
+            for directory, m in manifests
+            for shard in m["shards"]
+        ],
+    }
+
+
+def merge(script, paths):
+    """
+    Print the merged result of ``paths``, all partial aggregate files or all
+    output directories.
+    """
+    if not paths:
+        raise ValueError("Nothing to merge")
+    directories = [os.path.isdir(path) for path in paths]
+    if all(directories):
+        print(json.dumps(merge_manifests(paths), indent=2))
+    elif any(directories):
+        raise ValueError("Cannot merge output directories with partial aggregates")
+    elif script is None:
+        raise ValueError("Merging partial aggregates needs --script")
+    else:
+        print(merge_partials(script, paths))
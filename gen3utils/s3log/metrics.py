@@ -0,0 +1,118 @@
+"""
+Metrics of an s3log run in the Prometheus text format, served over HTTP for
+scraping or appended as JSON lines to a file.
+
+A metric is a ``(name, type, help, value)`` tuple, the value being a number,
+a list of ``(labels, number)`` pairs or a ``Histogram``.
+"""
+
+import asyncio
+import bisect
+import json
+import re
+import time
+
+# seconds, from a fast local read to a slow S3 GET
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+ADDRESS = re.compile(r"(?:(?P<host>[^:/\\]*):)?(?P<port>\d+)")
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # the last one counts values above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def parse_target(value):
+    """
+    Where ``--metrics`` sends the metrics: ``("http", host, port)`` for a
+    ``PORT`` or ``HOST:PORT`` value, otherwise ``("file", path)``.
+    """
+    match = ADDRESS.fullmatch(value)
+    if match is None:
+        return "file", value
+    return "http", match["host"] or "127.0.0.1", int(match["port"])
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels.items()
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def _samples(name, value):
+    if isinstance(value, Histogram):
+        cumulative = 0
+        for bound, count in zip([*value.buckets, "+Inf"], value.counts):
+            cumulative += count
+            yield f"{name}_bucket" + _labels({"le": bound}), cumulative
+        yield f"{name}_sum", value.sum
+        yield f"{name}_count", value.count
+    elif isinstance(value, list):
+        for labels, v in value:
+            yield name + _labels(labels), v
+    else:
+        yield name, value
+
+
+def prometheus(metrics):
+    lines = []
+    for name, kind, help, value in metrics:
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(f"{sample} {v}" for sample, v in _samples(name, value))
+    return "\n".join(lines) + "\n"
+
+
+def json_line(metrics):
+    """
+    One JSON object with the time and the same samples as the text format.
+    """
+    line = {"time": time.time()}
+    for name, _, _, value in metrics:
+        line.update(_samples(name, value))
+    return json.dumps(line)
+
+
+async def serve(host, port, metrics):
+    """
+    Answer ``GET /metrics`` with the Prometheus text format of ``metrics()``.
+    """
+
+    async def handle(reader, writer):
+        try:
+            request = (await reader.readline()).split()
+            # the headers do not matter
+            while (await reader.readline()).strip():
+                pass
+            path = request[1].split(b"?")[0] if len(request) > 1 else None
+            if request[:1] == [b"GET"] and path in (b"/", b"/metrics"):
+                status, body = b"200 OK", prometheus(metrics()).encode()
+            else:
+                status, body = b"404 Not Found", b""
+            writer.write(
+                b"HTTP/1.1 %s\r\n"
+                b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                b"Content-Length: %d\r\n"
+                b"Connection: close\r\n\r\n%s" % (status, len(body), body)
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
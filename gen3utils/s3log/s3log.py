@@ -1,8 +1,45 @@
-import aiobotocore
 import asyncio
+import collections
+import contextlib
+import functools
+import hashlib
+import heapq
+import importlib
+import io
+import itertools
+import json
+import multiprocessing
 import os
-import struct
+import pickle
+import re
+import sqlite3
 import sys
+import tempfile
+import time
+import traceback
+from datetime import datetime, timedelta, timezone
+
+from gen3utils.s3log import s3log_worker
+from gen3utils.s3log.metrics import Histogram, json_line, parse_target, serve
+from gen3utils.s3log.s3log_worker import (
+    CHUNK_HEADER,
+    FRAME_ERROR,
+    FRAME_HEADER,
+    FRAME_HELLO,
+    FRAME_RESULT,
+    GZIP_MAGIC,
+    HELLO,
+    OBJECT_HEADER,
+    PROTOCOL_VERSION,
+    RESULT,
+    RING_POLL,
+    ZSTD_MAGIC,
+    Ring,
+    compression_from_key,
+    read_file,
+    read_frame,
+)
+from gen3utils.s3log.sources import InventorySource, LocalSource, S3Source
 
 
 def _unitize(value):
@@ -13,12 +50,663 @@ def _unitize(value):
     return value, unit[0]
 
 
+def _rate(sub):
+    return (sub[-1][0] - sub[0][0]) / (sub[-1][1] - sub[0][1])
+
+
 def _speed(sub):
-    value = (sub[-1][0] - sub[0][0]) / (sub[-1][1] - sub[0][1])
-    value, unit = _unitize(value)
+    value, unit = _unitize(_rate(sub))
     return f"{value:.1f}{unit}B/s"
 
 
+def _duration(seconds):
+    return str(timedelta(seconds=round(seconds)))
+
+
+# records are assumed no larger than the worker's stream_json max_json
+RANGE_SLACK = 65536 * 16
+
+# bytes read from the start of a large object to tell whether it can be split
+SPLIT_PROBE = 65536
+
+KEY_QUEUE_SIZE = 10000
+
+# objects the script took the longest on, listed at the end
+SLOWEST = 5
+
+# date partitions like "2024/01/31" or "2024-01-31-23" in key names; an hour
+# is two digits on their own, not the start of a file name like 12345.json
+DEFAULT_KEY_TIME = (
+    r"(?P<year>\d{4})[/-](?P<month>\d{2})[/-](?P<day>\d{2})"
+    r"(?:[/-](?P<hour>\d{2})(?=[/_.-]|$))?"
+)
+
+
+def _utc(dt):
+    if dt is not None and dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt
+
+
+def _key_time_range(pattern, name):
+    """
+    Time range [start, end) covered by a key or prefix name according to the
+    ``year``/``month``/``day``/``hour``/``minute`` groups of ``pattern``, at
+    the finest unit matched. None if the name carries no date.
+    """
+    match = pattern.search(name)
+    if match is None:
+        return None
+    fields = match.groupdict()
+    values = []
+    for unit in ("year", "month", "day", "hour", "minute"):
+        if fields.get(unit) is None:
+            break
+        values.append(int(fields[unit]))
+    if not values:
+        return None
+    try:
+        start = datetime(*values, *[1] * (3 - len(values)), tzinfo=timezone.utc)
+    except ValueError:
+        # digits that are not a date, like build-1234-56-78.json
+        return None
+    if len(values) == 1:
+        end = start.replace(year=start.year + 1)
+    elif len(values) == 2:
+        end = (start + timedelta(days=31)).replace(day=1)
+    else:
+        end = start + timedelta(**{("days", "hours", "minutes")[len(values) - 3]: 1})
+    return start, end
+
+
+def _parse_shard(value):
+    """
+    ``(index, count)`` of a ``i/N`` shard, with ``0 <= i < N``.
+    """
+    match = re.fullmatch(r"(\d+)/(\d+)", value)
+    if match is None or not int(match[1]) < int(match[2]):
+        raise ValueError(f"Shard must be i/N with 0 <= i < N, not {value}")
+    return int(match[1]), int(match[2])
+
+
+def _key_shard(key, count):
+    # stable across processes and machines, unlike hash()
+    digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % count
+
+
+def _balanced_shard(entries, index, count):
+    """
+    Entries of shard ``index`` when assigning the largest remaining entry to
+    the least loaded shard. Every machine with the same listing gets the
+    same assignment, ties going by key and shard number.
+    """
+    loads = [(0, shard) for shard in range(count)]
+    mine = []
+    for entry in sorted(entries, key=lambda e: (-e["Size"], e["Key"])):
+        load, shard = heapq.heappop(loads)
+        if shard == index:
+            mine.append(entry)
+        heapq.heappush(loads, (load + entry["Size"], shard))
+    return sorted(mine, key=lambda e: e["Key"])
+
+
+class _RangeTrimmer:
+    """
+    Cut a ranged GET of newline-delimited JSON at line boundaries, the only
+    ones that cannot be inside a JSON string.
+
+    The fetched stream starts one byte before the range so a newline sitting
+    right before the range start is visible. Data up to the first newline
+    belongs to the previous range and is dropped, and the stream is cut after
+    the first newline at or past ``stop_from``, where the next range resyncs.
+    Both sides apply the same rule to the same bytes, so every record goes to
+    exactly one range.
+    """
+
+    def __init__(self, resync, stop_from):
+        self._started = not resync
+        self._stop_from = stop_from
+        self._offset = 0
+        self.done = False
+
+    def feed(self, chunk):
+        base = self._offset
+        self._offset += len(chunk)
+        start = 0
+        if not self._started:
+            newline = chunk.find(b"\n")
+            if newline < 0:
+                return b""
+            if self._stop_from is not None and base + newline >= self._stop_from:
+                self.done = True
+                return b""
+            self._started = True
+            start = newline + 1
+        if self._stop_from is None:
+            return chunk[start:]
+        newline = chunk.find(b"\n", max(start, self._stop_from - base))
+        if newline < 0:
+            return chunk[start:]
+        self.done = True
+        return chunk[start : newline + 1]
+
+
+class _Object:
+    def __init__(self, key, size, etag, start=0, end=None):
+        self.key = key
+        self.size = size
+        self.etag = etag
+        # byte range [start, end) for objects split across workers
+        self.start = start
+        self.end = end
+        # file in the object cache the worker reads instead of the chunks
+        self.path = None
+        self.chunks = collections.deque()
+        self.buffered = 0
+        self.attached = False
+        self.discarded = False
+        self.eof = False
+        self.readable = asyncio.Event()
+        self.writable = asyncio.Event()
+
+
+class _LargestFirstQueue(asyncio.Queue):
+    """
+    Queue of listed objects handing out the largest first (LPT scheduling),
+    so a huge object listed last does not leave one worker busy long after
+    the others are done.
+
+    Nothing is handed out before ``window`` objects are queued or the end of
+    the listing (None, which comes out last) is, so the first picks are
+    already made among many objects.
+    """
+
+    def __init__(self, window):
+        super().__init__(window)
+        self._window = window
+        self._dispatching = asyncio.Event()
+
+    def _init(self, maxsize):
+        self._queue = []
+        self._count = itertools.count()
+
+    def _put(self, obj):
+        size = float("inf") if obj is None else -obj.size
+        heapq.heappush(self._queue, (size, next(self._count), obj))
+        if obj is None or len(self._queue) >= self._window:
+            self._dispatching.set()
+
+    def _get(self):
+        return heapq.heappop(self._queue)[2]
+
+    async def get(self):
+        await self._dispatching.wait()
+        return await super().get()
+
+
+class _ChunkBuffer:
+    """
+    Bounded in-memory queue of fetched chunks, shared by every fetcher.
+
+    A fetcher whose object is not yet picked up by a worker waits while
+    ``limit`` bytes are buffered. Once a worker is attached to the object, its
+    fetcher may buffer up to ``per_object`` bytes regardless, so objects
+    waiting in the ready queue can never starve the ones being processed.
+    """
+
+    def __init__(self, limit, per_object):
+        self.limit = limit
+        self.per_object = per_object
+        self.used = 0
+        # unattached object -> size of the chunk it waits to put
+        self._blocked = {}
+
+    def _has_room(self, obj, size):
+        if obj.attached:
+            return obj.buffered == 0 or obj.buffered + size <= self.per_object
+        return self.used == 0 or self.used + size <= self.limit
+
+    async def put(self, obj, chunk):
+        size = len(chunk)
+        while not self._has_room(obj, size):
+            obj.writable.clear()
+            if not obj.attached:
+                self._blocked[obj] = size
+            await obj.writable.wait()
+        self._blocked.pop(obj, None)
+        if obj.discarded:
+            return
+        obj.chunks.append(chunk)
+        obj.buffered += size
+        self.used += size
+        obj.readable.set()
+
+    async def get(self, obj):
+        while not obj.chunks:
+            if obj.eof:
+                return None
+            obj.readable.clear()
+            await obj.readable.wait()
+        chunk = obj.chunks.popleft()
+        size = len(chunk)
+        obj.buffered -= size
+        self.used -= size
+        obj.writable.set()
+        self._wake()
+        return chunk
+
+    def _wake(self):
+        # each woken fetcher checks again, so none can overfill the buffer
+        for obj, size in self._blocked.items():
+            if self._has_room(obj, size):
+                obj.writable.set()
+
+    def discard(self, obj):
+        """
+        Drop the chunks of an object whose worker died, and any put later.
+        """
+        obj.discarded = True
+        size = sum(map(len, obj.chunks))
+        obj.chunks.clear()
+        obj.buffered = 0
+        self.used -= size
+        self._blocked.pop(obj, None)
+        obj.writable.set()
+        self._wake()
+
+    def attach(self, obj):
+        obj.attached = True
+        self._blocked.pop(obj, None)
+        obj.writable.set()
+
+    def close(self, obj):
+        obj.eof = True
+        obj.readable.set()
+
+
+class _Checkpoint:
+    """
+    Keys fully processed by a previous run, stored in a SQLite file so an
+    interrupted run can resume without fetching them again. Rows recorded by
+    another ``script`` (a hash of the script and how it is run) are ignored,
+    as their partial aggregates are not this one's.
+    """
+
+    def __init__(self, path, bucket, script):
+        self._bucket = bucket
+        self._script = script
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS processed ("
+            " bucket TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " etag TEXT,"
+            " size INTEGER NOT NULL,"
+            " lines INTEGER NOT NULL,"
+            " processed INTEGER NOT NULL,"
+            " partial BLOB,"
+            " script TEXT,"
+            " PRIMARY KEY (bucket, key))"
+        )
+        # last key listed by --follow under each prefix
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS marks ("
+            " bucket TEXT NOT NULL,"
+            " prefix TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " script TEXT,"
+            " PRIMARY KEY (bucket, prefix))"
+        )
+        for table, column, kind in [
+            ("processed", "partial", "BLOB"),
+            ("processed", "script", "TEXT"),
+            ("marks", "script", "TEXT"),
+        ]:
+            columns = [
+                row[1] for row in self._db.execute(f"PRAGMA table_info({table})")
+            ]
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {kind}")
+        self._db.commit()
+
+    def count(self):
+        return self._db.execute(
+            "SELECT COUNT(*) FROM processed WHERE bucket = ? AND script = ?",
+            (self._bucket, self._script),
+        ).fetchone()[0]
+
+    def lookup(self, key, etag):
+        """
+        None if the key still needs processing, otherwise the pickled partial
+        aggregate recorded for it (empty if the script does not aggregate).
+        """
+        row = self._db.execute(
+            "SELECT etag, partial, script FROM processed WHERE bucket = ? AND key = ?",
+            (self._bucket, key),
+        ).fetchone()
+        # a changed ETag means the object was overwritten since
+        if row is None or row[0] != etag or row[2] != self._script:
+            return None
+        return row[1] or b""
+
+    def mark(self, prefix):
+        row = self._db.execute(
+            "SELECT key FROM marks WHERE bucket = ? AND prefix = ? AND script = ?",
+            (self._bucket, prefix, self._script),
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_mark(self, prefix, key):
+        self._db.execute(
+            "INSERT OR REPLACE INTO marks (bucket, prefix, key, script)"
+            " VALUES (?, ?, ?, ?)",
+            (self._bucket, prefix, key, self._script),
+        )
+
+    def record(self, key, etag, size, lines, processed, partial=None):
+        self._db.execute(
+            "INSERT OR REPLACE INTO processed"
+            " (bucket, key, etag, size, lines, processed, partial, script)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (self._bucket, key, etag, size, lines, processed, partial, self._script),
+        )
+
+    def commit(self):
+        self._db.commit()
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+
+class _ResultCache:
+    """
+    Results of objects by ETag and script, stored in a SQLite file so later
+    runs of the same script skip the objects that did not change. The least
+    recently used results are evicted above ``max_size`` bytes.
+    """
+
+    def __init__(self, path, source, script, max_size):
+        self._source = source
+        self._script = script
+        self._max_size = max_size
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " source TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " etag TEXT NOT NULL,"
+            " script TEXT NOT NULL,"
+            " lines INTEGER NOT NULL,"
+            " processed INTEGER NOT NULL,"
+            " partial BLOB NOT NULL,"
+            " output BLOB NOT NULL,"
+            " used REAL NOT NULL,"
+            " PRIMARY KEY (source, key, etag, script))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+        self._db.commit()
+        self._size = self._db.execute(
+            "SELECT COALESCE(SUM(LENGTH(partial) + LENGTH(output)), 0) FROM results"
+        ).fetchone()[0]
+        self.hits = 0
+        self.stored = 0
+
+    def lookup(self, key, etag):
+        """
+        None on a miss, otherwise the lines, processed size, pickled partial
+        aggregate and output recorded for the object.
+        """
+        if etag is None:
+            return None
+        where = (self._source, key, etag, self._script)
+        row = self._db.execute(
+            "SELECT lines, processed, partial, output FROM results"
+            " WHERE source = ? AND key = ? AND etag = ? AND script = ?",
+            where,
+        ).fetchone()
+        if row is None:
+            return None
+        self._db.execute(
+            "UPDATE results SET used = ?"
+            " WHERE source = ? AND key = ? AND etag = ? AND script = ?",
+            (time.time(), *where),
+        )
+        self.hits += 1
+        return row
+
+    def store(self, key, etag, lines, processed, partial, output):
+        size = len(partial) + len(output)
+        if etag is None or size > self._max_size:
+            return
+        where = (self._source, key, etag, self._script)
+        replaced = self._db.execute(
+            "SELECT LENGTH(partial) + LENGTH(output) FROM results"
+            " WHERE source = ? AND key = ? AND etag = ? AND script = ?",
+            where,
+        ).fetchone()
+        if replaced is not None:
+            self._size -= replaced[0]
+        self._db.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                *where,
+                lines,
+                processed,
+                partial,
+                output,
+                time.time(),
+            ),
+        )
+        self.stored += 1
+        self._size += size
+        while self._size > self._max_size:
+            evicted = self._db.execute(
+                "SELECT rowid, LENGTH(partial) + LENGTH(output) FROM results"
+                " ORDER BY used LIMIT 100"
+            ).fetchall()
+            for rowid, evicted_size in evicted:
+                if self._size <= self._max_size:
+                    break
+                self._db.execute("DELETE FROM results WHERE rowid = ?", (rowid,))
+                self._size -= evicted_size
+
+    def commit(self):
+        self._db.commit()
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+
+class _ObjectCache:
+    """
+    Objects fetched from S3 kept as files in ``directory`` by key and ETag,
+    so later runs over the same logs, with any script, read them from disk
+    instead. A SQLite index tracks their use, and the least recently used
+    files are deleted above ``max_size`` bytes, except the ones being read.
+    """
+
+    def __init__(self, directory, source, max_size):
+        # workers get absolute paths
+        self._directory = os.path.abspath(directory)
+        self._source = source
+        self._max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            # left by an interrupted fetch
+            if name.endswith(".tmp"):
+                os.remove(os.path.join(directory, name))
+        self._db = sqlite3.connect(os.path.join(directory, "index.db"))
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS objects ("
+            " source TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " etag TEXT NOT NULL,"
+            " name TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " used REAL NOT NULL,"
+            " PRIMARY KEY (source, key, etag))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS objects_used ON objects (used)")
+        self._db.commit()
+        self._size = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM objects"
+        ).fetchone()[0]
+        # name -> number of readers
+        self._reading = collections.Counter()
+        self.hits = 0
+        self.stored = 0
+
+    def _name(self, key, etag):
+        digest = hashlib.blake2b(digest_size=16)
+        for part in (self._source, key, etag):
+            digest.update(part.encode() + b"\0")
+        return digest.hexdigest()
+
+    def lookup(self, key, etag):
+        """
+        Path of the cached object, kept until ``release(path)``, or None.
+        """
+        if etag is None:
+            return None
+        where = (self._source, key, etag)
+        row = self._db.execute(
+            "SELECT name FROM objects WHERE source = ? AND key = ? AND etag = ?",
+            where,
+        ).fetchone()
+        if row is None:
+            return None
+        path = os.path.join(self._directory, row[0])
+        if not os.path.exists(path):
+            self._remove(row[0])
+            return None
+        self._db.execute(
+            "UPDATE objects SET used = ? WHERE source = ? AND key = ? AND etag = ?",
+            (time.time(), *where),
+        )
+        self._reading[row[0]] += 1
+        self.hits += 1
+        return path
+
+    def release(self, path):
+        name = os.path.basename(path)
+        self._reading[name] -= 1
+        if not self._reading[name]:
+            del self._reading[name]
+
+    def writer(self, key, etag, size):
+        """
+        File to write a fetched object to, to ``store`` once complete, or
+        None when it cannot be cached.
+        """
+        if etag is None or size > self._max_size:
+            return None
+        # unique, a retry may fetch the object while the failed fetch ends
+        return tempfile.NamedTemporaryFile(
+            dir=self._directory, suffix=".tmp", delete=False
+        )
+
+    def store(self, key, etag, f):
+        f.close()
+        name = self._name(key, etag)
+        size = os.path.getsize(f.name)
+        os.replace(f.name, os.path.join(self._directory, name))
+        replaced = self._db.execute(
+            "SELECT size FROM objects WHERE name = ?", (name,)
+        ).fetchone()
+        if replaced is not None:
+            self._size -= replaced[0]
+        self._db.execute(
+            "INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?)",
+            (self._source, key, etag, name, size, time.time()),
+        )
+        self.stored += 1
+        self._size += size
+        if self._size > self._max_size:
+            for name, evicted_size in self._db.execute(
+                "SELECT name, size FROM objects ORDER BY used"
+            ).fetchall():
+                if self._size <= self._max_size:
+                    break
+                if name not in self._reading:
+                    self._remove(name)
+
+    def discard(self, f):
+        f.close()
+        os.remove(f.name)
+
+    def _remove(self, name):
+        (size,) = self._db.execute(
+            "SELECT size FROM objects WHERE name = ?", (name,)
+        ).fetchone()
+        self._db.execute("DELETE FROM objects WHERE name = ?", (name,))
+        self._size -= size
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(self._directory, name))
+
+    def commit(self):
+        self._db.commit()
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+
+class _ForkedWorker:
+    """
+    Worker process forked from a forkserver that imported the worker module
+    and the script once, with the ``stdin``/``stdout`` streams and ``wait``
+    of an asyncio subprocess.
+    """
+
+    def __init__(self, process, stdin, stdout):
+        self._process = process
+        self.stdin = stdin
+        self.stdout = stdout
+
+    @classmethod
+    async def start(cls, context, argv):
+        loop = asyncio.get_running_loop()
+        child_stdin, stdin = context.Pipe(duplex=False)
+        stdout, child_stdout = context.Pipe(duplex=False)
+        process = context.Process(
+            target=s3log_worker.forked_worker_main,
+            args=(argv, child_stdin, child_stdout),
+            daemon=True,
+        )
+        await loop.run_in_executor(None, process.start)
+        # the child has its own copies now, keep EOF working both ways
+        child_stdin.close()
+        child_stdout.close()
+
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), _detach(stdout, "rb")
+        )
+        # only its flow control is used, for StreamWriter.drain
+        transport, protocol = await loop.connect_write_pipe(
+            lambda: asyncio.StreamReaderProtocol(asyncio.StreamReader()),
+            _detach(stdin, "wb"),
+        )
+        writer = asyncio.StreamWriter(transport, protocol, None, loop)
+        return cls(process, writer, reader)
+
+    async def wait(self):
+        await asyncio.get_running_loop().run_in_executor(None, self._process.join)
+        return self._process.exitcode
+
+
+def _detach(connection, mode):
+    f = os.fdopen(os.dup(connection.fileno()), mode, buffering=0)
+    connection.close()
+    return f
+
+
 class S3Log:
     def __init__(
         self,
@@ -28,63 +716,800 @@ class S3Log:
         region,
         access_key_id,
         secret_access_key,
-        concurrency,
+        local,
+        inventory,
+        workers,
+        fetchers,
+        listers,
+        list_depth,
+        buffer,
+        split_size,
+        checkpoint,
+        cache,
+        cache_size,
+        object_cache,
+        object_cache_size,
+        output,
+        output_format,
+        output_compression,
+        since,
+        until,
+        key_time,
+        row_time,
+        batch_size,
+        decoder,
+        pool,
+        transport,
+        order,
+        in_process_below,
+        metrics,
+        shard,
+        shard_by,
+        partial,
+        follow,
+        poll_interval,
+        plan_only,
+        plan_throughput,
         progress,
     ):
-        self._bucket = bucket
+        if local and inventory:
+            raise ValueError("A local directory cannot be listed by an inventory")
+        if local:
+            self._source = LocalSource(bucket, prefix)
+        else:
+            s3_args = (
+                bucket,
+                prefix,
+                region,
+                access_key_id,
+                secret_access_key,
+                listers,
+                list_depth,
+            )
+            if inventory:
+                self._source = InventorySource(inventory, *s3_args)
+            else:
+                self._source = S3Source(*s3_args)
         self._prefix = prefix
         self._script = script
-        self._aws_region = region
-        self._aws_access_key_id = access_key_id
-        self._aws_secret_access_key = secret_access_key
-        self._concurrency = concurrency
+        self._workers = workers
+        self._fetchers = fetchers
+        self._listers = listers
+        self._list_depth = list_depth
+        if buffer < 1:
+            raise ValueError("--buffer must be at least 1 MiB")
+        self._buffer_size = buffer * 1024 * 1024
+        self._split_size = split_size * 1024 * 1024
+        self._checkpoint_path = checkpoint
+        self._cache_path = cache
+        self._cache_size = cache_size * 1024 * 1024
+        if local and object_cache:
+            raise ValueError("Local logs are read from disk already, no --object-cache")
+        self._object_cache_path = object_cache
+        self._object_cache_size = object_cache_size * 1024 * 1024
+        if output and cache:
+            # cached results are replayed as printed output
+            raise ValueError("--output cannot be used with --cache")
+        self._output = output
+        self._output_format = output_format
+        self._output_compression = output_compression
+        self._since = _utc(since)
+        self._until = _utc(until)
+        self._key_time = re.compile(key_time or DEFAULT_KEY_TIME)
+        self._row_time = row_time
+        self._batch_size = batch_size
+        self._decoder = decoder
+        self._pool = pool
+        self._transport = transport
+        self._order = order
+        # the first poll of --follow says nothing about the size of the next
+        self._in_process_below = 0 if follow else in_process_below * 1024 * 1024
+
+        module = importlib.import_module(self._script)
+        self._script_file = module.__file__
+        self._batched = hasattr(module, "handle_batch")
+        self._prefilter = getattr(module, "PREFILTER", None)
+        self._fields = getattr(module, "FIELDS", None)
+        if not self._batched and not hasattr(module, "handle_row"):
+            raise ValueError(
+                f"{self._script} defines neither handle_row(obj, line) "
+                "nor handle_batch(rows)"
+            )
+        self._init = getattr(module, "init", None)
+        self._merge = getattr(module, "merge", None)
+        self._finalize = getattr(module, "finalize", None)
+        if self._init is not None and self._merge is None:
+            raise ValueError(f"{self._script} defines init() but not merge(a, b)")
+        if partial and self._init is None:
+            raise ValueError(f"--partial needs {self._script} to define init()")
+        self._aggregate = None
+        self._metrics = metrics
+        if follow and (plan_only or inventory):
+            raise ValueError("--follow cannot be used with --plan-only or --inventory")
+        if follow and shard and shard_by == "size":
+            # each machine would balance the keys new since its own last poll
+            raise ValueError("--follow can only shard with --shard-by hash")
+        self._follow = follow
+        self._shard = _parse_shard(shard) if shard else None
+        self._shard_by = shard_by
+        self._partial_path = partial
+        self._poll_interval = poll_interval
+        self._plan_only = plan_only
+        self._plan_throughput = plan_throughput
         self._show_progress = progress
 
-        self._loop = asyncio.get_event_loop()
+        self._loop = None
         self._total_lines = 0
         self._total_received = 0
         self._total_processed = 0
         self._size_queue = []
-        self._q = asyncio.Queue()
-        self._tasks_queue = asyncio.Queue()
+        self._keys = None
+        self._ready = None
+        self._buffer = None
+        self._checkpoint = None
+        # hash of the script and its worker options, see _run
+        self._script_hash = None
+        self._cache = None
+        self._object_cache = None
+        self._worker_args = None
+        self._fork_context = None
+        self._handler = None
+        self._listed_size = 0
+        # set once listing is done or past the in-process threshold
+        self._sized = None
+        self._listed = False
+        self._procs = None
+        # worker -> its shared memory Ring, with the shm transport
+        self._rings = {}
+        self._window_start = 0
+        # --follow only lists the keys after the mark
+        self._mark = None
+        self._last_key = None
+        # key -> [ranges left, lines, processed, partials, outputs] for objects
+        # split in ranges
+        self._split_progress = {}
+        self._objects_listed = 0
+        self._objects_processed = 0
+        self._in_flight = 0
+        # worker -> seconds spent with an object
+        self._busy = collections.defaultdict(float)
+        self._first_byte = Histogram()
+        self._rows_matched = 0
+        self._rows_emitted = 0
+        self._decode_errors = 0
+        self._decode_seconds = Histogram()
+        self._handler_seconds = Histogram()
+        # (seconds in the script, key) of the slowest objects
+        self._slowest = []
+        self._failed = []
 
-        print(
-            f"Processing logs from {self._bucket}/{self._prefix} in {self._aws_region}",
-            file=sys.stderr,
-        )
-        print(f"Concurrency: {self._concurrency}", file=sys.stderr)
+        print(f"Processing logs from {self._source}", file=sys.stderr)
+        print(f"Fetchers: {self._fetchers}", file=sys.stderr)
+        if self._workers:
+            print(f"Workers: {self._workers} ({self._pool})", file=sys.stderr)
+            print(f"Transport: {self._transport}", file=sys.stderr)
+            if self._in_process_below:
+                print(
+                    "In process below: {:.1f}{}B".format(
+                        *_unitize(self._in_process_below)
+                    ),
+                    file=sys.stderr,
+                )
+        else:
+            print("Workers: none, processing in process", file=sys.stderr)
+        if isinstance(self._source, InventorySource):
+            print(f"Listers: {self._listers} (inventory files)", file=sys.stderr)
+        elif isinstance(self._source, S3Source):
+            print(
+                f"Listers: {self._listers} (sub-prefix depth: {self._list_depth})",
+                file=sys.stderr,
+            )
+        print("Buffer: {:.1f}{}B".format(*_unitize(self._buffer_size)), file=sys.stderr)
+        if self._split_size:
+            print(
+                "Split objects above: {:.1f}{}B".format(*_unitize(self._split_size)),
+                file=sys.stderr,
+            )
+        if self._checkpoint_path:
+            print(f"Checkpoint: {self._checkpoint_path}", file=sys.stderr)
+        if self._cache_path:
+            print(
+                "Result cache: {} (up to {:.1f}{}B)".format(
+                    self._cache_path, *_unitize(self._cache_size)
+                ),
+                file=sys.stderr,
+            )
+        if self._object_cache_path:
+            print(
+                "Object cache: {} (up to {:.1f}{}B)".format(
+                    self._object_cache_path, *_unitize(self._object_cache_size)
+                ),
+                file=sys.stderr,
+            )
+        if self._output:
+            print(
+                f"Output: {self._output} ({self._output_format}, "
+                f"{self._output_compression} compression)",
+                file=sys.stderr,
+            )
+        if self._since or self._until:
+            print(
+                f"Time window: {self._since or '-'} to {self._until or '-'}",
+                f"(rows by {self._row_time})" if self._row_time else "",
+                file=sys.stderr,
+            )
+        if self._init is not None:
+            print("Aggregating with init/merge", file=sys.stderr)
+        if self._prefilter:
+            print(f"Prefilter: {self._prefilter!r}", file=sys.stderr)
+        if self._fields:
+            print(f"Fields: {', '.join(self._fields)}", file=sys.stderr)
+        if self._batched:
+            print(f"Batches of {self._batch_size} rows", file=sys.stderr)
+        print(f"Order: {self._order}", file=sys.stderr)
+        print(f"JSON decoder: {self._decoder}", file=sys.stderr)
+        if self._metrics:
+            print(f"Metrics: {self._metrics}", file=sys.stderr)
+        if self._shard is not None:
+            print(
+                f"Shard: {self._shard[0]}/{self._shard[1]} (by {self._shard_by})",
+                file=sys.stderr,
+            )
+        if self._follow:
+            print(f"Following new logs every {self._poll_interval}s", file=sys.stderr)
+        if self._plan_only:
+            print("Plan only, not fetching anything", file=sys.stderr)
         print(f"Show progress: {self._show_progress}", file=sys.stderr)
 
-    async def _wait(self):
+    async def _fetch(self):
         while True:
-            task = await self._tasks_queue.get()
-            if not task:
+            obj = await self._keys.get()
+            if obj is None:
                 break
-            await task
-
-    async def feed(self, client, key, proc):
-        response = await client.get_object(Bucket=self._bucket, Key=key)
-        # this will ensure the connection is correctly re-used/closed
-        async with response["Body"] as stream:
-            size = 0
-            while True:
-                chunk = await stream.readany()
-                if not chunk:
-                    break
-                proc.stdin.write(chunk)
-                len_chunk = len(chunk)
-                size += len_chunk
-                self._total_received += len_chunk
-                if size > 65536:
-                    size = 0
-                    await proc.stdin.drain()
-            proc.stdin.write(b"\x00")
-            await proc.stdin.drain()
-            result = await proc.stdout.read(16)
-            await self._q.put(proc)
-            lines, size = struct.unpack("QQ", result)
-            self._total_lines += lines
-            self._total_processed += size
+            await self._fetch_object(obj)
+
+    async def _fetch_object(self, obj, dispatch=True):
+        # dispatched objects go to any free worker, the others are fed directly
+        queued = not dispatch
+        fetch_start = fetch_end = None
+        trimmer = None
+        if obj.end is not None:
+            fetch_start = max(obj.start - 1, 0)
+            fetch_end = min(obj.end + RANGE_SLACK, obj.size)
+            trimmer = _RangeTrimmer(
+                obj.start > 0,
+                obj.end - 1 - fetch_start if obj.end < obj.size else None,
+            )
+        cached = None
+        if self._object_cache is not None and obj.end is None:
+            if obj.path is None:
+                obj.path = self._object_cache.lookup(obj.key, obj.etag)
+            if obj.path is not None:
+                # the worker reads it from disk
+                self._total_received += obj.size
+                self._buffer.close(obj)
+                if not queued:
+                    await self._ready.put(obj)
+                return
+            cached = self._object_cache.writer(obj.key, obj.etag, obj.size)
+        requested = self._loop.time()
+        try:
+            async with contextlib.aclosing(
+                self._source.read(obj.key, fetch_start, fetch_end)
+            ) as stream:
+                async for chunk in stream:
+                    if obj.discarded:
+                        break
+                    if requested is not None:
+                        self._first_byte.observe(self._loop.time() - requested)
+                        requested = None
+                    self._total_received += len(chunk)
+                    if cached is not None:
+                        cached.write(chunk)
+                    if trimmer is not None:
+                        chunk = trimmer.feed(chunk)
+                    if chunk:
+                        await self._put(obj, chunk, queued)
+                        queued = True
+                    if trimmer is not None and trimmer.done:
+                        trimmer = None
+                        break
+            if cached is not None and not obj.discarded:
+                self._object_cache.store(obj.key, obj.etag, cached)
+                cached = None
+        finally:
+            if cached is not None:
+                self._object_cache.discard(cached)
+            self._buffer.close(obj)
+            if not queued:
+                await self._ready.put(obj)
+
+    async def _put(self, obj, chunk, queued):
+        await self._buffer.put(obj, chunk)
+        if not queued:
+            # first data for this object: hand it to any free worker
+            await self._ready.put(obj)
+
+    def _start(self, obj):
+        if obj.end is None:
+            print(f"Processing key: {obj.key}", file=sys.stderr)
+        else:
+            print(f"Processing key: {obj.key} [{obj.start}-{obj.end})", file=sys.stderr)
+        self._buffer.attach(obj)
+
+    def _done(self, obj, lines, size, payload, output=b"", cached=False):
+        if obj.path is not None:
+            self._object_cache.release(obj.path)
+        self._objects_processed += 1
+        self._total_lines += lines
+        self._total_processed += size
+        if output:
+            sys.stdout.write(output.decode(errors="surrogateescape"))
+        if self._init is not None:
+            self._merge_partial(payload)
+        if self._checkpoint is None and self._cache is None:
+            return
+        if obj.end is not None:
+            whole = self._whole_object(obj, lines, size, payload, output)
+            if whole is None:
+                return
+            lines, size, payload, output = whole
+        if self._checkpoint is not None:
+            self._checkpoint.record(
+                obj.key, obj.etag, obj.size, lines, size, payload or None
+            )
+        if self._cache is not None and not cached:
+            self._cache.store(obj.key, obj.etag, lines, size, payload, output)
+
+    async def feed(self, obj, proc):
+        self._start(obj)
+        key = obj.key.encode()
+        path = obj.path.encode() if obj.path is not None else b""
+        proc.stdin.write(OBJECT_HEADER.pack(len(key), len(path)) + key + path)
+        ring = self._rings.get(proc)
+        size = 0
+        while True:
+            chunk = await self._buffer.get(obj)
+            if chunk is None:
+                break
+            if ring is not None:
+                await self._write_ring(ring, proc, chunk)
+                continue
+            proc.stdin.write(CHUNK_HEADER.pack(len(chunk)))
+            proc.stdin.write(chunk)
+            size += len(chunk)
+            if size > 65536:
+                size = 0
+                await proc.stdin.drain()
+        if not path:
+            proc.stdin.write(CHUNK_HEADER.pack(0))
+        await proc.stdin.drain()
+        kind, body = await read_frame(proc.stdout)
+        if kind == FRAME_ERROR:
+            self._fail(obj, body.decode(errors="replace"))
+            return
+        if kind != FRAME_RESULT:
+            raise RuntimeError(f"Unexpected frame {kind} from worker")
+        (
+            lines,
+            size,
+            matched,
+            emitted,
+            decode_errors,
+            decode_time,
+            handler_time,
+            payload_size,
+            _,
+        ) = RESULT.unpack_from(body)
+        payload = body[RESULT.size : RESULT.size + payload_size]
+        output = body[RESULT.size + payload_size :]
+        self._count(obj, matched, emitted, decode_errors, decode_time, handler_time)
+        self._done(obj, lines, size, payload, output)
+
+    def _count(self, obj, matched, emitted, decode_errors, decode_time, handler_time):
+        self._rows_matched += matched
+        self._rows_emitted += emitted
+        self._decode_errors += decode_errors
+        self._decode_seconds.observe(decode_time)
+        self._handler_seconds.observe(handler_time)
+        slowest = (handler_time, obj.key)
+        if len(self._slowest) < SLOWEST:
+            heapq.heappush(self._slowest, slowest)
+        else:
+            heapq.heappushpop(self._slowest, slowest)
+        if decode_errors:
+            print(
+                f"Cannot decode {decode_errors} records of key: {obj.key}",
+                file=sys.stderr,
+            )
+
+    def _fail(self, obj, error):
+        """
+        Report an object the script failed on. It is not recorded, so it is
+        processed again by the next run with the same checkpoint.
+        """
+        if obj.path is not None:
+            self._object_cache.release(obj.path)
+        self._failed.append(obj.key)
+        if obj.end is not None:
+            # the whole object cannot be recorded anymore
+            self._split_progress.pop(obj.key, None)
+        print(f"Failed processing key: {obj.key}\n{error}", file=sys.stderr, end="")
+
+    async def _write_ring(self, ring, proc, chunk):
+        data = memoryview(chunk)
+        while data:
+            written = ring.write(data)
+            if not written:
+                # full: let the worker get the headers of what it has to read
+                await proc.stdin.drain()
+                await asyncio.sleep(RING_POLL)
+                continue
+            proc.stdin.write(CHUNK_HEADER.pack(written))
+            data = data[written:]
+
+    async def _chunks(self, obj):
+        while True:
+            chunk = await self._buffer.get(obj)
+            if chunk is None:
+                break
+            yield chunk
+
+    async def _process_in_process(self):
+        while True:
+            obj = await self._ready.get()
+            if obj is None:
+                # leave it for the other consumers
+                self._ready.put_nowait(None)
+                break
+            started = self._loop.time()
+            self._in_flight += 1
+            try:
+                self._start(obj)
+                if self._handler.capture:
+                    self._handler.output = io.StringIO()
+                chunks = self._chunks(obj)
+                if obj.path is not None:
+                    chunks = read_file(obj.path)
+                try:
+                    lines, size, state = await self._handler.process(obj.key, chunks)
+                except Exception:
+                    self._buffer.discard(obj)
+                    if self._handler.sink is not None:
+                        self._handler.sink.discard_object()
+                    self._fail(obj, traceback.format_exc())
+                    continue
+                handler = self._handler
+                self._count(
+                    obj,
+                    handler.matched,
+                    handler.emitted,
+                    handler.decode_errors,
+                    handler.decode_time,
+                    handler.handler_time,
+                )
+                payload = pickle.dumps(state) if self._init is not None else b""
+                output = b""
+                if self._handler.capture:
+                    output = self._handler.output.getvalue().encode(
+                        errors="surrogateescape"
+                    )
+                self._done(obj, lines, size, payload, output)
+            finally:
+                self._in_flight -= 1
+                self._busy["main"] += self._loop.time() - started
+
+    def _merge_partial(self, payload):
+        self._aggregate = self._merge(self._aggregate, pickle.loads(payload))
+
+    def _whole_object(self, obj, lines, processed, payload, output):
+        """
+        Add the result of a range to the others of its object. Once all are
+        in, returns the lines, processed size, partial aggregate and output
+        of the whole object, otherwise None, as when another range failed.
+        """
+        progress = self._split_progress.get(obj.key)
+        if progress is None:
+            return None
+        progress[0] -= 1
+        progress[1] += lines
+        progress[2] += processed
+        progress[3].append(payload)
+        progress[4].append((obj.start, output))
+        if progress[0]:
+            return None
+        del self._split_progress[obj.key]
+        lines, processed, payloads, outputs = progress[1:]
+        payload = b""
+        if self._init is not None:
+            partial = functools.reduce(
+                self._merge, map(pickle.loads, payloads), self._init()
+            )
+            payload = pickle.dumps(partial)
+        return lines, processed, payload, b"".join(o for _, o in sorted(outputs))
+
+    async def _spawn(self):
+        args = self._worker_args
+        ring = None
+        if self._transport == "shm":
+            ring = Ring.create()
+            args = [*args, "--ring", ring.path]
+        try:
+            proc = await self._start_worker(args)
+        except BaseException:
+            if ring is not None:
+                ring.close()
+            raise
+        if ring is not None:
+            # the worker mapped it before saying hello
+            ring.unlink()
+            self._rings[proc] = ring
+        return proc
+
+    async def _start_worker(self, args):
+        if self._fork_context is not None:
+            proc = await _ForkedWorker.start(self._fork_context, args)
+        else:
+            proc = await asyncio.create_subprocess_exec(
+                sys.executable,
+                os.path.join(
+                    os.path.dirname(os.path.abspath(__file__)), "s3log_worker.py"
+                ),
+                *args,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=sys.stdout,
+            )
+        hello = FRAME_HEADER.pack(FRAME_HELLO, HELLO.size) + HELLO.pack(
+            PROTOCOL_VERSION
+        )
+        try:
+            received = await proc.stdout.readexactly(len(hello))
+        except asyncio.IncompleteReadError:
+            raise RuntimeError(f"Worker exited with code {await proc.wait()} on start")
+        if received != hello:
+            # e.g. a script printing to stdout when imported by a subprocess
+            raise RuntimeError(
+                f"Worker does not speak protocol version {PROTOCOL_VERSION}, "
+                f"it started with {received!r}"
+            )
+        return proc
+
+    def _close_ring(self, proc):
+        ring = self._rings.pop(proc, None)
+        if ring is not None:
+            ring.close()
+
+    async def _consume(self, worker, proc):
+        while True:
+            obj = await self._ready.get()
+            if obj is None:
+                # leave it for the other consumers
+                self._ready.put_nowait(None)
+                break
+            started = self._loop.time()
+            self._in_flight += 1
+            try:
+                await self.feed(obj, proc)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                returncode = await proc.wait()
+                print(
+                    f"Worker exited with code {returncode} processing {obj.key},"
+                    " restarting it",
+                    file=sys.stderr,
+                )
+                self._buffer.discard(obj)
+                self._close_ring(proc)
+                proc = await self._spawn()
+                # the data sent to the dead worker is lost, so fetch it again;
+                # a second failure is most likely the script, not bad luck
+                retry = _Object(obj.key, obj.size, obj.etag, obj.start, obj.end)
+                retry.path = obj.path
+                fetch = self._loop.create_task(
+                    self._fetch_object(retry, dispatch=False)
+                )
+                try:
+                    await self.feed(retry, proc)
+                except BaseException:
+                    # nothing consumes what it fetches anymore
+                    fetch.cancel()
+                    await asyncio.gather(fetch, return_exceptions=True)
+                    self._buffer.discard(retry)
+                    raise
+                await fetch
+            finally:
+                self._in_flight -= 1
+                self._busy[worker] += self._loop.time() - started
+        # possibly restarted
+        return proc
+
+    async def _consume_all(self):
+        if self._procs is None:
+            await self._start_workers()
+        if self._handler is not None:
+            await self._process_in_process()
+        else:
+            self._procs = await asyncio.gather(
+                *(self._consume(i, p) for i, p in enumerate(self._procs))
+            )
+
+    async def _start_workers(self):
+        in_process = not self._workers
+        if not in_process and self._in_process_below:
+            # small enough runs are faster without starting any worker
+            await self._sized.wait()
+            in_process = self._listed_size <= self._in_process_below
+            if in_process:
+                print(
+                    "Processing {:.1f}{}B in process".format(
+                        *_unitize(self._listed_size)
+                    ),
+                    file=sys.stderr,
+                )
+        if in_process:
+            self._handler = s3log_worker.make_handler(self._worker_args)
+            self._handler.output = sys.stdout
+            self._procs = []
+            return
+        if self._pool == "forkserver":
+            self._fork_context = multiprocessing.get_context("forkserver")
+            # imported once in the forkserver instead of in every worker; with
+            # __main__ there, workers do not run the main script again either
+            self._fork_context.set_forkserver_preload(
+                ["__main__", "gen3utils.s3log.s3log_worker", self._script]
+            )
+        self._procs = await asyncio.gather(
+            *(self._spawn() for _ in range(self._workers))
+        )
+
+    async def _stop_workers(self):
+        if self._handler is not None and self._handler.sink is not None:
+            self._handler.sink.close()
+        for proc in self._procs or ():
+            proc.stdin.close()
+        await asyncio.gather(*(proc.wait() for proc in self._procs or ()))
+        for proc in self._procs or ():
+            self._close_ring(proc)
+
+    def _in_window(self, name):
+        if self._since is None and self._until is None:
+            return True
+        time_range = _key_time_range(self._key_time, name)
+        if time_range is None:
+            # no date in the name, cannot tell
+            return True
+        start, end = time_range
+        return (self._since is None or end > self._since) and (
+            self._until is None or start < self._until
+        )
+
+    async def _enqueue(self, entry):
+        key, size, etag = entry["Key"], entry["Size"], entry.get("ETag")
+        if self._last_key is None or key > self._last_key:
+            self._last_key = key
+        if (
+            self._shard is not None
+            and self._shard_by == "hash"
+            and _key_shard(key, self._shard[1]) != self._shard[0]
+        ):
+            return
+        if not self._in_window(key):
+            return
+        if self._checkpoint is not None:
+            partial = self._checkpoint.lookup(key, etag)
+            if partial and self._init is not None:
+                self._merge_partial(partial)
+                return
+            # without a recorded partial, an aggregating run has to redo the key
+            if partial is not None and self._init is None:
+                return
+        if self._cache is not None:
+            cached = self._cache.lookup(key, etag)
+            if cached is not None:
+                if not self._plan_only:
+                    self._done(_Object(key, size, etag), *cached, cached=True)
+                return
+        self._objects_listed += 1
+        self._listed_size += size
+        if self._listed_size > self._in_process_below:
+            self._sized.set()
+        if self._plan_only:
+            return
+        if (
+            not self._split_size
+            or size <= self._split_size
+            or compression_from_key(key)
+            or not await self._splittable(key)
+        ):
+            await self._put_key(_Object(key, size, etag))
+            return
+        # large object: each byte range goes to a different worker
+        starts = range(0, size, self._split_size)
+        if self._checkpoint is not None or self._cache is not None:
+            # results of the ranges, recorded once all are in
+            self._split_progress[key] = [len(starts), 0, 0, [], []]
+        for start in starts:
+            end = min(start + self._split_size, size)
+            await self._put_key(_Object(key, size, etag, start, end))
+
+    async def _put_key(self, obj):
+        if self._keys.full():
+            # listing waits for the fetchers, which may wait for a consumer to
+            # empty the buffer: decide how to process with what is listed
+            self._sized.set()
+        await self._keys.put(obj)
+
+    async def _splittable(self, key):
+        """
+        Whether ``key`` looks like uncompressed newline-delimited JSON, its
+        first line being a whole JSON value, whatever its name. Ranges of
+        anything else could not be cut at record boundaries, so those objects
+        are read whole.
+        """
+        head = b""
+        async with contextlib.aclosing(
+            self._source.read(key, 0, SPLIT_PROBE)
+        ) as stream:
+            async for chunk in stream:
+                head += chunk
+        if head.startswith((GZIP_MAGIC, ZSTD_MAGIC)):
+            return False
+        line, newline, _ = head.partition(b"\n")
+        if not newline:
+            return False
+        try:
+            json.loads(line)
+        except ValueError:
+            return False
+        return True
+
+    async def _list(self):
+        self._listed = False
+        await self._list_keys()
+        self._listed = True
+        self._sized.set()
+        for _ in range(self._fetchers):
+            await self._keys.put(None)
+
+    async def _list_keys(self):
+        """
+        Enqueue the keys of this run, the ones of its shard with ``--shard``.
+        """
+        if self._shard is not None and self._shard_by == "size":
+            await self._list_balanced()
+        else:
+            await self._source.list(self._enqueue, self._in_window, self._mark)
+
+    async def _list_balanced(self):
+        # the whole listing is needed before anything can be assigned
+        entries = []
+
+        async def collect(entry):
+            if self._last_key is None or entry["Key"] > self._last_key:
+                self._last_key = entry["Key"]
+            if self._in_window(entry["Key"]):
+                entries.append(entry)
+
+        await self._source.list(collect, self._in_window, self._mark)
+        print(f"Balancing {len(entries)} keys between shards", file=sys.stderr)
+        for entry in _balanced_shard(entries, *self._shard):
+            await self._enqueue(entry)
+
+    async def _fetch_all(self):
+        await asyncio.gather(
+            self._list(), *(self._fetch() for _ in range(self._fetchers))
+        )
+        await self._ready.put(None)
+
+    async def _commit(self):
+        while True:
+            await asyncio.sleep(5)
+            if self._checkpoint is not None:
+                self._checkpoint.commit()
+            if self._cache is not None:
+                self._cache.commit()
+            if self._object_cache is not None:
+                self._object_cache.commit()
 
     async def _status(self):
         start = [(0, self._loop.time())]
@@ -101,47 +1526,411 @@ class S3Log:
                 f"AVG: {_speed(start + self._size_queue[-1:])}\t",
                 f"JSON: {self._total_processed / self._total_lines if self._total_lines else 0:,.0f}B",
                 "Size: {:.1f}{}B".format(*_unitize(self._total_processed)),
+                "Buffered: {:.1f}{}B".format(*_unitize(self._buffer.used)),
+                self._eta(),
                 file=sys.stderr,
             )
 
+    def _eta(self):
+        """
+        Share of the listed bytes passed to the workers so far, with the time
+        left at the MA20 speed once the listing is complete.
+        """
+        if not self._listed_size:
+            return ""
+        # ranges overlap a little, so received bytes can exceed the total
+        received = min(self._total_received - self._buffer.used, self._listed_size)
+        done = "Done: {:.1f}% of {:.1f}{}B".format(
+            100 * received / self._listed_size, *_unitize(self._listed_size)
+        )
+        if not self._listed:
+            return done + " listed so far"
+        rate = _rate(self._size_queue[-20:])
+        if not rate:
+            return done
+        return f"{done} ETA: {_duration((self._listed_size - received) / rate)}"
+
+    async def _plan(self):
+        await self._list_keys()
+        print(
+            f"Keys: {self._objects_listed:,}",
+            "Size: {:.1f}{}B".format(*_unitize(self._listed_size)),
+            sep="\n",
+        )
+        seconds = self._listed_size / (self._plan_throughput * 1024 * 1024)
+        print(
+            f"Estimated runtime: {_duration(seconds)}",
+            f"at {self._plan_throughput:g}MiB/s",
+        )
+
+    def _collect_metrics(self):
+        busy = dict(self._busy)
+        return [
+            (
+                "s3log_listed_objects_total",
+                "counter",
+                "Objects listed for processing.",
+                self._objects_listed,
+            ),
+            (
+                "s3log_listed_bytes_total",
+                "counter",
+                "Size of the objects listed for processing.",
+                self._listed_size,
+            ),
+            (
+                "s3log_received_bytes_total",
+                "counter",
+                "Bytes received from the source.",
+                self._total_received,
+            ),
+            (
+                "s3log_processed_objects_total",
+                "counter",
+                "Objects and object ranges processed.",
+                self._objects_processed,
+            ),
+            (
+                "s3log_processed_bytes_total",
+                "counter",
+                "Bytes of JSON processed.",
+                self._total_processed,
+            ),
+            (
+                "s3log_processed_lines_total",
+                "counter",
+                "Rows processed.",
+                self._total_lines,
+            ),
+            (
+                "s3log_objects_in_flight",
+                "gauge",
+                "Objects being sent to or processed by a worker.",
+                self._in_flight,
+            ),
+            (
+                "s3log_worker_busy_seconds_total",
+                "counter",
+                "Time each worker spent with an object.",
+                [({"worker": w}, round(busy[w], 6)) for w in sorted(busy, key=str)],
+            ),
+            (
+                "s3log_queue_depth",
+                "gauge",
+                "Objects waiting in each queue.",
+                [
+                    ({"queue": "fetch"}, self._keys.qsize()),
+                    ({"queue": "ready"}, self._ready.qsize()),
+                ],
+            ),
+            (
+                "s3log_buffered_bytes",
+                "gauge",
+                "Bytes fetched and waiting for a worker.",
+                self._buffer.used,
+            ),
+            (
+                "s3log_get_first_byte_seconds",
+                "histogram",
+                "Time from requesting an object to its first bytes.",
+                self._first_byte,
+            ),
+            (
+                "s3log_requests_total",
+                "counter",
+                "Requests to S3 by operation and HTTP status.",
+                [
+                    ({"operation": op, "status": status}, count)
+                    for (op, status), count in sorted(self._source.requests.items())
+                ],
+            ),
+            (
+                "s3log_cache_hits_total",
+                "counter",
+                "Objects whose result came from the result cache.",
+                self._cache.hits if self._cache is not None else 0,
+            ),
+            (
+                "s3log_object_cache_hits_total",
+                "counter",
+                "Objects read from the object cache instead of S3.",
+                self._object_cache.hits if self._object_cache is not None else 0,
+            ),
+            (
+                "s3log_matched_rows_total",
+                "counter",
+                "Rows given to the script, past PREFILTER and the time window.",
+                self._rows_matched,
+            ),
+            (
+                "s3log_emitted_rows_total",
+                "counter",
+                "Results output by the script.",
+                self._rows_emitted,
+            ),
+            (
+                "s3log_decode_errors_total",
+                "counter",
+                "Records that could not be decoded.",
+                self._decode_errors,
+            ),
+            (
+                "s3log_failed_objects_total",
+                "counter",
+                "Objects and object ranges the script raised an exception on.",
+                len(self._failed),
+            ),
+            (
+                "s3log_object_decode_seconds",
+                "histogram",
+                "Seconds spent decompressing and decoding each object.",
+                self._decode_seconds,
+            ),
+            (
+                "s3log_object_handler_seconds",
+                "histogram",
+                "Seconds spent in the script for each object.",
+                self._handler_seconds,
+            ),
+        ]
+
+    async def _write_metrics(self, path):
+        with open(path, "a") as f:
+            try:
+                while True:
+                    await asyncio.sleep(1)
+                    print(json_line(self._collect_metrics()), file=f, flush=True)
+            finally:
+                # the final counts
+                print(json_line(self._collect_metrics()), file=f, flush=True)
+
+    def _new_queues(self):
+        # let listing run well ahead of the fetchers
+        if self._order == "largest-first":
+            self._keys = _LargestFirstQueue(KEY_QUEUE_SIZE)
+        else:
+            self._keys = asyncio.Queue(KEY_QUEUE_SIZE)
+        # objects with data ready, waiting for a free worker
+        self._ready = asyncio.Queue()
+
+    async def _process_all(self):
+        # a failing stage aborts the whole run instead of stalling the others
+        await asyncio.gather(self._fetch_all(), self._consume_all())
+        while self._follow:
+            self._end_window()
+            await asyncio.sleep(self._poll_interval)
+            self._new_queues()
+            await asyncio.gather(self._fetch_all(), self._consume_all())
+        await self._stop_workers()
+
+    def _end_window(self):
+        """
+        Move the mark past the keys listed so far and print the aggregate of
+        the logs processed since the previous poll, starting a new one.
+        """
+        if self._last_key is not None and self._last_key != self._mark:
+            self._mark = self._last_key
+            if self._checkpoint is not None:
+                self._checkpoint.set_mark(self._prefix, self._mark)
+                self._checkpoint.commit()
+        if self._init is None or self._objects_processed == self._window_start:
+            return
+        print(
+            f"Window ending {datetime.now(timezone.utc).isoformat(timespec='seconds')}:",
+            f"{self._objects_processed - self._window_start} objects",
+            file=sys.stderr,
+        )
+        self._print_result()
+        self._aggregate = self._init()
+        self._window_start = self._objects_processed
+
+    def _print_result(self):
+        result = self._aggregate
+        if self._finalize is not None:
+            result = self._finalize(result)
+        print(result, flush=True)
+
     async def _run(self):
-        for i in range(self._concurrency):
-            proc = await asyncio.create_subprocess_exec(
-                sys.executable,
-                os.path.join(
-                    os.path.dirname(os.path.abspath(__file__)), "s3log_worker.py"
-                ),
-                self._script,
-                stdin=asyncio.subprocess.PIPE,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=sys.stdout,
+        self._loop = asyncio.get_running_loop()
+        if self._init is not None:
+            self._aggregate = self._init()
+        self._new_queues()
+        self._buffer = _ChunkBuffer(
+            self._buffer_size,
+            max(self._buffer_size // max(self._workers, 1), 65536 * 16),
+        )
+        self._sized = asyncio.Event()
+
+        worker_args = [self._script]
+        if self._row_time:
+            worker_args += ["--row-time", self._row_time]
+            if self._since:
+                worker_args += ["--since", self._since.isoformat()]
+            if self._until:
+                worker_args += ["--until", self._until.isoformat()]
+        if self._batched:
+            worker_args += ["--batch-size", str(self._batch_size)]
+        worker_args += ["--decoder", self._decoder]
+        if self._output:
+            self._prepare_output()
+            worker_args += [
+                "--output",
+                os.path.abspath(self._output),
+                "--output-format",
+                self._output_format,
+                "--output-compression",
+                self._output_compression,
+            ]
+        # results depend on the script and on how it is run
+        digest = hashlib.sha256()
+        with open(self._script_file, "rb") as f:
+            digest.update(f.read())
+        digest.update("\0".join(worker_args).encode())
+        self._script_hash = digest.hexdigest()
+        if self._checkpoint_path:
+            self._checkpoint = _Checkpoint(
+                self._checkpoint_path, self._source.name, self._script_hash
+            )
+            print(
+                f"Skipping up to {self._checkpoint.count()} keys already processed",
+                file=sys.stderr,
+            )
+            if self._follow:
+                self._mark = self._checkpoint.mark(self._prefix)
+                if self._mark is not None:
+                    print(f"Following after key {self._mark}", file=sys.stderr)
+        if self._cache_path:
+            worker_args += ["--capture-output"]
+            self._cache = _ResultCache(
+                self._cache_path, self._source.name, self._script_hash, self._cache_size
+            )
+        self._worker_args = worker_args
+        if self._object_cache_path:
+            self._object_cache = _ObjectCache(
+                self._object_cache_path, self._source.name, self._object_cache_size
             )
-            await self._q.put(proc)
 
-        session = aiobotocore.get_session(loop=self._loop)
-        async with session.create_client(
-            "s3",
-            region_name=self._aws_region,
-            aws_secret_access_key=self._aws_secret_access_key,
-            aws_access_key_id=self._aws_access_key_id,
-        ) as client:
+        async with self._source:
+            if self._plan_only:
+                try:
+                    await self._plan()
+                finally:
+                    self._close()
+                return
+            background = []
             if self._show_progress:
-                self._loop.create_task(self._status())
-            waiter = self._loop.create_task(self._wait())
-            # # list s3 objects using paginator
-            paginator = client.get_paginator("list_objects")
-            async for result in paginator.paginate(
-                Bucket=self._bucket, Prefix=self._prefix
+                background.append(self._loop.create_task(self._status()))
+            if (
+                self._checkpoint is not None
+                or self._cache is not None
+                or self._object_cache is not None
             ):
-                for c in result.get("Contents", []):
-                    key = c["Key"]
-                    print(f"Processing key: {key}", file=sys.stderr)
-                    proc = await self._q.get()
-                    await self._tasks_queue.put(
-                        self._loop.create_task(self.feed(client, key, proc))
+                background.append(self._loop.create_task(self._commit()))
+            server = None
+            if self._metrics:
+                kind, *where = parse_target(self._metrics)
+                if kind == "http":
+                    server = await serve(*where, self._collect_metrics)
+                else:
+                    background.append(
+                        self._loop.create_task(self._write_metrics(*where))
                     )
-            await self._tasks_queue.put(None)
-            await waiter
+            try:
+                await self._process_all()
+                self._print_stats()
+                if self._output:
+                    self._write_manifest()
+            finally:
+                for task in background:
+                    task.cancel()
+                await asyncio.gather(*background, return_exceptions=True)
+                if server is not None:
+                    server.close()
+                for proc in list(self._rings):
+                    self._close_ring(proc)
+                # keep what was acknowledged so far, even on failure
+                self._close()
+        if self._init is not None and not self._plan_only:
+            self._print_result()
+            if self._partial_path:
+                with open(self._partial_path, "wb") as f:
+                    pickle.dump(self._aggregate, f)
+
+    def _print_stats(self):
+        print(
+            f"Rows: {self._total_lines:,}, {self._rows_matched:,} given to "
+            f"{self._script}, {self._rows_emitted:,} results, "
+            f"{self._decode_errors:,} not decoded",
+            file=sys.stderr,
+        )
+        print(
+            f"Decoding: {self._decode_seconds.sum:.1f}s, "
+            f"{self._script}: {self._handler_seconds.sum:.1f}s",
+            file=sys.stderr,
+        )
+        if self._slowest:
+            print(
+                f"Slowest in {self._script}:",
+                ", ".join(
+                    f"{key} ({seconds:.2f}s)"
+                    for seconds, key in sorted(self._slowest, reverse=True)
+                ),
+                file=sys.stderr,
+            )
+        if self._failed:
+            print(
+                f"Failed: {len(self._failed)} objects, {', '.join(self._failed)}",
+                file=sys.stderr,
+            )
+
+    def _prepare_output(self):
+        os.makedirs(self._output, exist_ok=True)
+        for name in os.listdir(self._output):
+            # a manifest listing shards of two runs would be wrong
+            if name.startswith("part-") or name == "manifest.json":
+                raise ValueError(f"{self._output} holds the output of another run")
+
+    def _write_manifest(self):
+        shards = [
+            {"path": name, "size": os.path.getsize(os.path.join(self._output, name))}
+            for name in sorted(os.listdir(self._output))
+            if name.startswith("part-") and not name.endswith(".tmp")
+        ]
+        manifest = {
+            "format": self._output_format,
+            "compression": self._output_compression,
+            "objects": self._objects_processed,
+            "lines": self._total_lines,
+            "shards": shards,
+        }
+        with open(os.path.join(self._output, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
+        print(
+            f"Output: {len(shards)} shards listed in "
+            f"{os.path.join(self._output, 'manifest.json')}",
+            file=sys.stderr,
+        )
+
+    def _close(self):
+        if self._checkpoint is not None:
+            self._checkpoint.close()
+        if self._cache is not None:
+            self._cache.close()
+            print(
+                f"Result cache: {self._cache.hits} hits, {self._cache.stored} stored",
+                file=sys.stderr,
+            )
+        if self._object_cache is not None:
+            self._object_cache.close()
+            print(
+                f"Object cache: {self._object_cache.hits} hits, "
+                f"{self._object_cache.stored} stored",
+                file=sys.stderr,
+            )
 
     def run(self):
-        self._loop.run_until_complete(self._run())
+        """
+        Returns the number of objects the script failed on.
+        """
+        asyncio.run(self._run())
+        return len(self._failed)
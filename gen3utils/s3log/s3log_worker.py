@@ -1,83 +1,1070 @@
+import argparse
 import asyncio
+import codecs
+import contextlib
+import gzip
 import importlib
+import io
+import json
+import mmap
+import os
+import pickle
 import re
 import struct
 import sys
+import tempfile
+import time
+import traceback
+import zlib
+from datetime import datetime, timezone
 from json import JSONDecoder, JSONDecodeError
+from typing import Any
+
+try:
+    # Python 3.14+
+    from compression.zstd import ZstdDecompressor as _zstd_decompressobj
+    from compression.zstd import compress as _zstd_compress
+except ImportError:
+    try:
+        import zstandard
+
+        def _zstd_decompressobj():
+            return zstandard.ZstdDecompressor().decompressobj()
+
+        def _zstd_compress(data):
+            return zstandard.ZstdCompressor().compress(data)
+
+    except ImportError:
+        _zstd_decompressobj = _zstd_compress = None
 
 NOT_WHITESPACE = re.compile(r"[^\s]")
 
+# integers the fast parsers cannot hold exactly (e.g. orjson makes them
+# floats) are found as runs of this many digits, with digits mapped to "0"
+LONG_NUMBER = b"0" * 19
+DIGITS = bytes.maketrans(b"123456789", b"000000000")
 
-async def stream_json(
-    stdin, buf_size=65536, max_json=65536 * 16, decoder=JSONDecoder()
-):
-    buf = ""
-    ex = None
-    pending = True
-    while pending:
-        chunk = await stdin.read(buf_size)
-        if chunk:
-            buf += chunk.decode()
+MAX_JSON = 65536 * 16
+
+# partial lines longer than this are scanned as concatenated JSON
+MAX_LINE = 65536
+
+# Each object is sent as its key, then length-prefixed chunks ending with an
+# empty one, so compressed (binary) data can go through the pipe as is. Objects
+# already on disk are sent as their key and the path to read them from instead.
+OBJECT_HEADER = struct.Struct("HH")
+CHUNK_HEADER = struct.Struct("I")
+
+# Workers answer with frames: their kind and the length of their body, then
+# the body. A HELLO with the PROTOCOL_VERSION comes first, then a RESULT or an
+# ERROR (the traceback, as text) per object.
+PROTOCOL_VERSION = 2
+FRAME_HEADER = struct.Struct("<BI")
+FRAME_HELLO = 1
+FRAME_RESULT = 2
+FRAME_ERROR = 3
+HELLO = struct.Struct("<H")
+# lines, bytes, rows given to the script, results it emitted, records that
+# could not be decoded, seconds decoding and in the script, and the sizes of
+# the following pickled partial aggregate and captured output
+RESULT = struct.Struct("<QQQQQddII")
+
+# With a shared memory ring, chunks are copied to the ring and only their
+# CHUNK_HEADER goes through the pipe. The ring starts with the total bytes
+# consumed by the worker, then the data, written and read in the same order.
+RING_HEADER = struct.Struct("Q")
+RING_DATA = 64
+RING_SIZE = 8 * 1024 * 1024
+# seconds the parent waits for the worker to free space in a full ring
+RING_POLL = 0.001
+
+DEFAULT_BATCH_SIZE = 4096
+
+# size of the chunks read from files, like a large S3 response read
+FILE_CHUNK_SIZE = 1024 * 1024
+
+# output shards are closed once they reach this size, or this many rows for
+# Parquet, which is written a whole shard at a time
+SHARD_SIZE = 128 * 1024 * 1024
+PARQUET_SHARD_ROWS = 262144
+# NDJSON rows of an object held in memory before going to a file of their own
+OBJECT_ROWS = 4096
+SHARD_SUFFIXES = {
+    ("ndjson", "none"): ".ndjson",
+    ("ndjson", "gzip"): ".ndjson.gz",
+    ("ndjson", "zstd"): ".ndjson.zst",
+    ("parquet", "none"): ".parquet",
+    ("parquet", "gzip"): ".parquet",
+    ("parquet", "zstd"): ".parquet",
+}
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def compression_from_key(key):
+    if key.endswith((".gz", ".gzip")):
+        return "gzip"
+    if key.endswith((".zst", ".zstd")):
+        return "zstd"
+    return None
+
+
+def _decompressobj(compression):
+    if compression == "gzip":
+        return zlib.decompressobj(zlib.MAX_WBITS | 16)
+    if _zstd_decompressobj is None:
+        raise RuntimeError(
+            "zstd compressed logs need Python 3.14+ or `pip install zstandard`"
+        )
+    return _zstd_decompressobj()
+
+
+def _compress(compression, data):
+    if compression == "gzip":
+        return gzip.compress(data, compresslevel=6)
+    if compression == "zstd":
+        if _zstd_compress is None:
+            raise RuntimeError(
+                "zstd compressed output needs Python 3.14+ or `pip install zstandard`"
+            )
+        return _zstd_compress(data)
+    return data
+
+
+async def decompress(key, chunks):
+    compression = compression_from_key(key)
+    d = None
+    async for chunk in chunks:
+        if d is None:
+            if compression is None:
+                # chunks may be memoryviews
+                magic = bytes(chunk[:4])
+                if magic.startswith(GZIP_MAGIC):
+                    compression = "gzip"
+                elif magic.startswith(ZSTD_MAGIC):
+                    compression = "zstd"
+                else:
+                    compression = "none"
+            if compression == "none":
+                yield chunk
+                async for chunk in chunks:
+                    yield chunk
+                return
+            d = _decompressobj(compression)
+        while chunk:
+            data = d.decompress(chunk)
+            if data:
+                yield data
+            # concatenated gzip members or zstd frames
+            chunk = d.unused_data if d.eof else b""
+            if d.eof:
+                d = _decompressobj(compression)
+
+
+def _field_tree(fields):
+    """
+    Nested dict of the names in dotted ``fields``, None for values kept whole.
+    """
+    tree = {}
+    for field in fields:
+        node = tree
+        *parents, name = field.split(".")
+        for parent in parents:
+            node = node.setdefault(parent, {})
+            if node is None:
+                # the whole parent is kept already
+                break
+        else:
+            node[name] = None
+    return tree
+
+
+def _project(obj, tree):
+    out = {}
+    for name, sub in tree.items():
+        if name in obj:
+            value = obj[name]
+            if sub is None:
+                out[name] = value
+            elif type(value) is dict:
+                out[name] = _project(value, sub)
+    return out
+
+
+def projection(fields):
+    """
+    Reduce a row to the dotted ``fields``. Missing fields, or fields under a
+    value that is not an object, are left out. Rows that are not objects are
+    kept as they are.
+    """
+    tree = _field_tree(fields)
+
+    def project(row):
+        return _project(row, tree) if type(row) is dict else row
+
+    return project
+
+
+def _orjson(fields=None):
+    import orjson
+
+    if not fields:
+        return orjson.loads, orjson.JSONDecodeError
+    loads = orjson.loads
+    project = projection(fields)
+    return (lambda raw: project(loads(raw))), orjson.JSONDecodeError
+
+
+def _msgspec_struct(msgspec, tree):
+    # generated attribute names, as JSON keys need not be identifiers
+    attrs = []
+    rename = {}
+    for i, (name, sub) in enumerate(tree.items()):
+        rename[f"f{i}"] = name
+        field_type = Any if sub is None else _msgspec_struct(msgspec, sub)
+        attrs.append((f"f{i}", field_type, msgspec.UNSET))
+    return msgspec.defstruct("Row", attrs, rename=rename)
+
+
+def _msgspec(fields=None):
+    import msgspec
+
+    if not fields:
+        return msgspec.json.Decoder().decode, msgspec.DecodeError
+    # only the declared fields are built, the rest is skipped while parsing;
+    # rows where they do not fit (e.g. a string instead of an object) fail
+    # validation and go to the stdlib fallback
+    decode = msgspec.json.Decoder(_msgspec_struct(msgspec, _field_tree(fields))).decode
+    to_builtins = msgspec.to_builtins
+    return (lambda raw: to_builtins(decode(raw))), msgspec.DecodeError
+
+
+# fast parsers for whole lines holding a single JSON value, in order of preference
+LINE_DECODERS = {"orjson": _orjson, "msgspec": _msgspec}
+
+# with fields, msgspec skips the others while parsing where orjson builds them all
+FIELDS_DECODERS = ["msgspec", "orjson"]
+
+
+def line_decoder(name="auto", fields=None):
+    """
+    ``(loads, error)`` of the line parser to use, or None for the stdlib one.
+    ``auto`` picks the first installed one of ``LINE_DECODERS``, or of
+    ``FIELDS_DECODERS`` with ``fields``. With ``fields``, rows are reduced to
+    them like ``projection`` does.
+    """
+    if name == "json":
+        return None
+    if name != "auto":
+        return LINE_DECODERS[name](fields)
+    for name in FIELDS_DECODERS if fields else LINE_DECODERS:
+        try:
+            return LINE_DECODERS[name](fields)
+        except ImportError:
+            pass
+    return None
+
+
+class Ring:
+    """
+    Shared memory byte ring between the parent, writing chunks, and one
+    worker, reading them. It is a memory-mapped file in ``/dev/shm`` (or the
+    temporary directory elsewhere), so workers started any way can map it by
+    path.
+    """
+
+    def __init__(self, path, size=None):
+        self.path = path
+        with open(path, "r+b") as f:
+            if size is not None:
+                f.truncate(RING_DATA + size)
+            self._map = mmap.mmap(f.fileno(), 0)
+        self._view = memoryview(self._map)
+        self.size = len(self._map) - RING_DATA
+        self._written = 0
+        self._consumed = 0
+
+    @classmethod
+    def create(cls, size=RING_SIZE):
+        directory = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        fd, path = tempfile.mkstemp(prefix="s3log-", suffix=".ring", dir=directory)
+        os.close(fd)
+        return cls(path, size)
+
+    def write(self, data):
+        """
+        Copy as much of ``data`` as fits contiguously, returning how much. 0
+        means the ring is full until the worker consumes more.
+        """
+        (consumed,) = RING_HEADER.unpack_from(self._map)
+        offset = self._written % self.size
+        n = min(len(data), self.size - (self._written - consumed), self.size - offset)
+        if n > 0:
+            start = RING_DATA + offset
+            self._view[start : start + n] = data[:n]
+            self._written += n
+        return max(n, 0)
+
+    async def read(self, stdin):
+        """
+        Chunks whose CHUNK_HEADER come from ``stdin``, as memoryviews of the
+        ring valid until the next one is asked for.
+        """
+        while True:
+            (size,) = CHUNK_HEADER.unpack(await stdin.readexactly(CHUNK_HEADER.size))
+            if not size:
+                break
+            start = RING_DATA + self._consumed % self.size
+            with self._view[start : start + size] as chunk:
+                yield chunk
+            self._consumed += size
+            RING_HEADER.pack_into(self._map, 0, self._consumed)
+
+    def unlink(self):
+        """
+        Remove the file, once both sides have it mapped: the memory is freed
+        when they unmap it, whichever way they exit.
+        """
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+
+    def close(self):
+        self._view.release()
+        self._map.close()
+        self.unlink()
+
+
+def write_frame(stdout, kind, *body):
+    stdout.write(FRAME_HEADER.pack(kind, sum(map(len, body))))
+    for part in body:
+        stdout.write(part)
+    stdout.flush()
+
+
+async def read_frame(stdout):
+    kind, size = FRAME_HEADER.unpack(await stdout.readexactly(FRAME_HEADER.size))
+    return kind, await stdout.readexactly(size)
+
+
+async def read_object(stdin, ring=None):
+    try:
+        header = await stdin.readexactly(OBJECT_HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise
+        raise EOFError()
+    key_len, path_len = OBJECT_HEADER.unpack(header)
+    key = (await stdin.readexactly(key_len)).decode()
+    if path_len:
+        path = (await stdin.readexactly(path_len)).decode()
+        return key, read_file(path)
+    if ring is not None:
+        return key, ring.read(stdin)
+    return key, _read_chunks(stdin)
+
+
+async def _read_chunks(stdin):
+    while True:
+        (size,) = CHUNK_HEADER.unpack(await stdin.readexactly(CHUNK_HEADER.size))
+        if not size:
+            break
+        yield await stdin.readexactly(size)
+
+
+async def read_file(path, start=None, end=None):
+    """
+    Chunks of the file at ``path``, only the range [start, end) when given.
+    The file is memory-mapped, so reading it again is at page cache speed.
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            # empty files cannot be mapped
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            position = start or 0
+            end = size if end is None else min(end, size)
+            while position < end:
+                chunk = data[position : min(position + FILE_CHUNK_SIZE, end)]
+                position += len(chunk)
+                yield chunk
+
+
+class _RecordBuffer:
+    """
+    Split a byte stream into JSON records.
+
+    Newline-delimited JSON takes a fast path: each complete line is decoded
+    on its own. Anything else (concatenated or pretty-printed records, bad
+    lines) falls back to scanning with ``raw_decode`` from the first line
+    that does not decode. With a ``line_decoder``, lines are parsed by it
+    instead, and anything it rejects also goes to the stdlib fallback. Bytes
+    stay in a ``bytearray`` consumed from the front, so nothing is copied
+    until a record is decoded, and UTF-8 characters split across chunks are
+    held back until complete.
+
+    Records not matching ``prefilter`` are skipped, and only counted in
+    ``skipped`` and ``skipped_size``. On the line path it is tested before
+    decoding. Records decoded by the stdlib are passed through ``project``,
+    which a ``line_decoder`` is expected to apply itself.
+    """
+
+    def __init__(
+        self, decoder, max_json, line_decoder=None, prefilter=None, project=None
+    ):
+        self._decoder = decoder
+        # only the fast parsers lose long integers
+        self._exact = line_decoder is None
+        if line_decoder is None and prefilter is not None:
+            # the prefilter needs the raw bytes of each line
+            def loads(raw):
+                obj = decoder.decode(raw.decode())
+                return obj if project is None else project(obj)
+
+            line_decoder = (loads, ValueError)
+        self._line_decoder = line_decoder
+        self._prefilter = prefilter
+        self._project = project
+        self._max_json = max_json
+        self.skipped = 0
+        self.skipped_size = 0
+        self.errors = 0
+        self._buf = bytearray()
+        self._pos = 0
+        # where to resume looking for a newline in a partial line
+        self._searched = 0
+
+    def feed(self, chunk):
+        if self._pos:
+            # deleting from the front of a bytearray does not move the data
+            del self._buf[: self._pos]
+            self._searched -= self._pos
+            self._pos = 0
+        self._buf += chunk
+
+    def records(self, final=False):
+        """
+        Records complete so far as ``(obj, line)`` pairs, all remaining ones
+        if ``final``.
+        """
+        out = []
+        buf = self._buf
+        pos = self._pos
+        end = len(buf)
+        last = end - 1 if final else buf.rfind(b"\n", max(pos, self._searched))
+        if last < pos:
+            if end - pos > MAX_LINE:
+                # not newline-delimited after all
+                self._pos = self._scan(pos, final, out)
+            else:
+                self._searched = end
+            return out
+        if self._line_decoder is not None:
+            self._pos = self._decode_lines(pos, last, final, out)
+            return out
+        # only complete lines, so no UTF-8 character is cut
+        text = buf[pos : last + 1].decode("utf-8", "surrogateescape")
+        raw_decode = self._decoder.raw_decode
+        project = self._project
+        start = 0
+        size = len(text)
+        while start < size:
+            nl = text.find("\n", start)
+            if nl < 0:
+                nl = size
+            try:
+                obj, stop = raw_decode(text, start)
+            except JSONDecodeError:
+                if text[start:nl].strip():
+                    break
+            else:
+                if stop != nl and not text[stop:nl].isspace():
+                    break
+                if project is not None:
+                    obj = project(obj)
+                out.append((obj, text[start:stop]))
+            start = nl + 1
+        if start < size:
+            pos += len(text[:start].encode("utf-8", "surrogateescape"))
+            self._pos = self._scan(pos, final, out)
         else:
-            pending = False
-        pos = 0
-        buf_len = len(buf)
-        while pos < buf_len:
-            match = NOT_WHITESPACE.search(buf, pos)
+            self._pos = last + 1
+        return out
+
+    def _decode_lines(self, pos, last, final, out):
+        buf = self._buf
+        loads, error = self._line_decoder
+        prefilter = self._prefilter
+        long_number = -1
+        if not self._exact:
+            long_number = buf[pos : last + 1].translate(DIGITS).find(LONG_NUMBER)
+            if long_number >= 0:
+                long_number += pos
+        while pos <= last:
+            nl = buf.find(b"\n", pos, last + 1)
+            if nl < 0:
+                nl = last + 1
+            if 0 <= long_number < nl:
+                return self._scan(pos, final, out)
+            raw = buf[pos:nl].strip()
+            if raw and prefilter is not None and not prefilter(raw):
+                self.skipped += 1
+                self.skipped_size += len(raw)
+            elif raw:
+                try:
+                    obj = loads(raw)
+                except error:
+                    return self._scan(pos, final, out)
+                out.append((obj, raw.decode("utf-8", "surrogateescape")))
+            pos = nl + 1
+        return last + 1
+
+    def _scan(self, pos, final, out):
+        buf = self._buf
+        text = codecs.getincrementaldecoder("utf-8")("surrogateescape").decode(
+            buf[pos:], final
+        )
+        # an error before the last line cannot be fixed by more data
+        last_line = text.rfind("\n")
+        done = 0
+        while True:
+            match = NOT_WHITESPACE.search(text, done)
             if not match:
+                done = len(text)
                 break
-            pos = match.start()
-            if buf[pos] == "\x00":
-                return
-            start = pos
+            start = match.start()
             try:
-                obj, pos = decoder.raw_decode(buf, pos)
+                obj, done = self._decoder.raw_decode(text, start)
             except JSONDecodeError as e:
-                if (not pending or len(buf) > max_json - buf_size) and (
-                    ex is None or ex.pos == e.pos
+                if (
+                    not final
+                    and e.pos > last_line
+                    and len(text) - start < self._max_json
                 ):
-                    pos = e.pos + 1
-                    ex = None
-                else:
-                    print(
-                        f"Cannot get JSON from chunk: {e}. Chunk:\n{buf}",
-                        file=sys.stderr,
-                    )
-                    ex = e
+                    # most likely a record split across reads, wait for more data
+                    done = start
                     break
+                # resync on the next line
+                skip = text.find("\n", start)
+                if skip < 0:
+                    skip = len(text)
+                print(
+                    f"Cannot get JSON from chunk: {e}. Chunk:\n{text[start:skip]}",
+                    file=sys.stderr,
+                )
+                self.errors += 1
+                done = skip
             else:
-                ex = None
-                yield obj, buf[start:pos]
-        buf = buf[pos:]
-        if ex is not None:
-            raise ex
-    raise EOFError()
+                line = text[start:done]
+                if self._prefilter is not None and not self._prefilter(
+                    line.encode("utf-8", "surrogateescape")
+                ):
+                    self.skipped += 1
+                    self.skipped_size += len(line)
+                elif self._project is not None:
+                    out.append((self._project(obj), line))
+                else:
+                    out.append((obj, line))
+        return pos + len(text[:done].encode("utf-8", "surrogateescape"))
+
 
+async def _iter_records(records, chunks):
+    async for chunk in chunks:
+        records.feed(chunk)
+        for record in records.records():
+            yield record
+    for record in records.records(final=True):
+        yield record
 
-async def worker(loop, handle_row):
-    stdin = asyncio.StreamReader()
-    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(stdin), sys.stdin)
+
+async def stream_json(
+    chunks,
+    max_json=MAX_JSON,
+    decoder=JSONDecoder(),
+    line_decoder=None,
+    prefilter=None,
+    project=None,
+):
+    records = _RecordBuffer(decoder, max_json, line_decoder, prefilter, project)
+    async for record in _iter_records(records, chunks):
+        yield record
+
+
+def prefilter_matcher(prefilter):
+    """
+    Test for the raw bytes of a record from a script's ``PREFILTER``: a
+    literal that must appear in it (bytes or str) or a compiled bytes regex.
+    """
+    if isinstance(prefilter, str):
+        prefilter = prefilter.encode()
+    if isinstance(prefilter, bytes):
+        return lambda raw: prefilter in raw
+    return prefilter.search
+
+
+def parse_time(value):
+    """
+    Timestamp of a log row as seconds since the epoch, from an ISO 8601
+    string (UTC unless an offset is given) or an epoch number.
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
     try:
-        while True:
-            lines = 0
-            size = 0
-            async for row, line in stream_json(stdin):
-                lines += 1
-                size += len(line)
-                output = handle_row(row, line)
+        dt = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+def field_getter(field):
+    """
+    Read a field of a row, with dots for nested fields. None if missing.
+    """
+    path = field.split(".")
+
+    def get(row):
+        value = row
+        for name in path:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(name)
+        return value
+
+    return get
+
+
+def time_filter(field, since=None, until=None):
+    get = field_getter(field)
+    since = parse_time(since) if since else float("-inf")
+    until = parse_time(until) if until else float("inf")
+
+    def accept(row):
+        ts = parse_time(get(row))
+        # rows without a usable timestamp are left to the script
+        return ts is None or since <= ts < until
+
+    return accept
+
+
+def columns(fields):
+    """
+    Turn a batch of rows into a dict of field -> list of values, one per row.
+    """
+    getters = [(field, field_getter(field)) for field in fields]
+
+    def to_columns(rows):
+        if not all(type(row) is dict for row in rows):
+            return {field: [get(row) for row in rows] for field, get in getters}
+        # fast path for the usual rows of JSON objects, without a call per value
+        cols = {}
+        for field, _ in getters:
+            name, _, rest = field.partition(".")
+            values = [row.get(name) for row in rows]
+            while rest:
+                name, _, rest = rest.partition(".")
+                values = [v.get(name) if type(v) is dict else None for v in values]
+            cols[field] = values
+        return cols
+
+    return to_columns
+
+
+def declared_fields(module, row_time=None):
+    """
+    Fields rows are reduced to when the script declares ``FIELDS``, with the
+    ones read by the worker itself. None to keep whole rows.
+    """
+    fields = getattr(module, "FIELDS", None)
+    if not fields:
+        return None
+    fields = [*fields, *(getattr(module, "BATCH_FIELDS", None) or ())]
+    if row_time:
+        fields.append(row_time)
+    return fields
+
+
+def _ndjson_line(value):
+    if isinstance(value, str):
+        return value.encode(errors="surrogateescape") + b"\n"
+    if isinstance(value, bytes):
+        return value + b"\n"
+    return json.dumps(value, default=str).encode() + b"\n"
+
+
+class ShardWriter:
+    """
+    Script output written to numbered shards in ``directory`` instead of
+    printed. NDJSON rows are written once their object is done, each object
+    compressed on its own (concatenated gzip members or zstd frames are
+    valid), so a worker dying mid-object leaves no partial rows. Objects with
+    more than ``OBJECT_ROWS`` rows are written in batches to a temporary file
+    renamed to a shard of their own when done. Parquet shards need
+    ``pyarrow`` and are written whole, rows that are not dicts going in an
+    ``output`` column.
+    """
+
+    def __init__(self, directory, format="ndjson", compression="none"):
+        if format == "parquet":
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError as e:
+                raise ImportError(f"{e}: Parquet output needs pyarrow") from e
+            self._pyarrow = pyarrow
+        self.directory = directory
+        self.format = format
+        self.compression = compression
+        # workers of the same run write to the same directory
+        self._prefix = f"part-{os.getpid()}"
+        self._suffix = SHARD_SUFFIXES[format, compression]
+        self._shards = 0
+        self._file = None
+        self._object_rows = []
+        self._object_path = None
+        self._object_file = None
+        self._rows = []
+
+    def _path(self):
+        self._shards += 1
+        name = f"{self._prefix}-{self._shards:05d}{self._suffix}"
+        return os.path.join(self.directory, name)
+
+    def write(self, value):
+        self._object_rows.append(value)
+        if self.format == "ndjson" and len(self._object_rows) >= OBJECT_ROWS:
+            self._spill()
+
+    def _spill(self):
+        rows, self._object_rows = self._object_rows, []
+        if self._object_file is None:
+            self._object_path = self._path()
+            self._object_file = open(self._object_path + ".tmp", "wb")
+        data = b"".join(map(_ndjson_line, rows))
+        self._object_file.write(_compress(self.compression, data))
+
+    def discard_object(self):
+        self._object_rows = []
+        if self._object_file is not None:
+            self._object_file.close()
+            self._object_file = None
+            os.remove(self._object_path + ".tmp")
+
+    def end_object(self):
+        if self._object_file is not None:
+            self._spill()
+            self._object_file.close()
+            self._object_file = None
+            os.rename(self._object_path + ".tmp", self._object_path)
+            return
+        rows, self._object_rows = self._object_rows, []
+        if not rows:
+            return
+        if self.format == "parquet":
+            self._rows.extend(rows)
+            if len(self._rows) >= PARQUET_SHARD_ROWS:
+                self._write_parquet()
+            return
+        if self._file is None:
+            self._file = open(self._path(), "wb")
+        data = b"".join(map(_ndjson_line, rows))
+        self._file.write(_compress(self.compression, data))
+        self._file.flush()
+        if self._file.tell() >= SHARD_SIZE:
+            self._file.close()
+            self._file = None
+
+    def _write_parquet(self):
+        rows = [r if isinstance(r, dict) else {"output": r} for r in self._rows]
+        self._rows = []
+        path = self._path()
+        # readers never see a shard without its footer
+        self._pyarrow.parquet.write_table(
+            self._pyarrow.Table.from_pylist(rows),
+            path + ".tmp",
+            compression=self.compression,
+        )
+        os.rename(path + ".tmp", path)
+
+    def close(self):
+        self.end_object()
+        if self._rows:
+            self._write_parquet()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class Handler:
+    """
+    Run the functions of a handler script over the rows of log objects.
+
+    Scripts define ``handle_row(obj, line)``, called once per row, or
+    ``handle_batch(rows)``, called with lists of up to ``batch_size`` rows. A
+    script declaring ``BATCH_FIELDS`` gets a dict of field -> list of values
+    instead of the rows. With ``init``, both also receive the aggregate of the
+    object being processed and may return a new one. Records not matching a
+    ``PREFILTER`` are skipped before being decoded, and rows only hold the
+    ``fields`` given (see ``declared_fields``), if any.
+    """
+
+    def __init__(
+        self,
+        module,
+        row_filter=None,
+        batch_size=DEFAULT_BATCH_SIZE,
+        line_decoder=None,
+        fields=None,
+    ):
+        self.handle_row = getattr(module, "handle_row", None)
+        self.handle_batch = getattr(module, "handle_batch", None)
+        self.init = getattr(module, "init", None)
+        self.row_filter = row_filter
+        self.batch_size = batch_size
+        self.line_decoder = line_decoder
+        self.project = projection(fields) if fields else None
+        self.prefilter = None
+        if getattr(module, "PREFILTER", None):
+            self.prefilter = prefilter_matcher(module.PREFILTER)
+        # script output, the parent's stdout for worker processes
+        self.output = sys.stderr
+        # send the output of each object back with its result instead
+        self.capture = False
+        # or write it to a ShardWriter
+        self.sink = None
+        # Ring the chunks of worker processes are in, if not in the pipe
+        self.ring = None
+        # counters of the last object processed
+        self.matched = 0
+        self.emitted = 0
+        self.decode_errors = 0
+        self.decode_time = 0
+        self.wait_time = 0
+        self.handler_time = 0
+        self.to_columns = None
+        if getattr(module, "BATCH_FIELDS", None):
+            self.to_columns = columns(module.BATCH_FIELDS)
+
+    def _call_batch(self, rows, state):
+        batch = self.to_columns(rows) if self.to_columns is not None else rows
+        if self.init is not None:
+            result = self.handle_batch(batch, state)
+            return state if result is None else result
+        # array-like results have no truth value
+        result = self.handle_batch(batch)
+        if result is not None:
+            for output in result:
                 if output:
-                    print(output, file=sys.stderr)
-            sys.stdout.buffer.write(struct.pack("QQ", lines, size))
-            sys.stdout.flush()
+                    self._emit(output)
+        return state
+
+    def _emit(self, output):
+        self.emitted += 1
+        if self.sink is not None:
+            self.sink.write(output)
+        else:
+            print(output, file=self.output)
+
+    async def _records(self, key, chunks, records):
+        """
+        Records of an object, adding the seconds spent decompressing and
+        decoding them to ``decode_time`` and the seconds spent waiting for its
+        chunks to ``wait_time``.
+        """
+        perf_counter = time.perf_counter
+
+        async def received():
+            start = perf_counter()
+            async for chunk in chunks:
+                self.wait_time += perf_counter() - start
+                yield chunk
+                start = perf_counter()
+            self.wait_time += perf_counter() - start
+
+        # timed per chunk, the script runs while this is suspended
+        start = perf_counter()
+        # decompression happens here to spread its CPU cost over the workers
+        async for chunk in decompress(key, received()):
+            records.feed(chunk)
+            batch = records.records()
+            self.decode_time += perf_counter() - start
+            for record in batch:
+                yield record
+            start = perf_counter()
+        batch = records.records(final=True)
+        self.decode_time += perf_counter() - start - self.wait_time
+        for record in batch:
+            yield record
+
+    async def process(self, key, chunks):
+        """
+        Feed the rows of an object to the script. Returns the number of rows,
+        their total size and the partial aggregate of the object. The rows
+        given to the script, the results it emitted, the records that could
+        not be decoded and the seconds spent decoding and in the script are
+        left in ``matched``, ``emitted``, ``decode_errors``, ``decode_time``
+        and ``handler_time``.
+        """
+        started = time.perf_counter()
+        lines = 0
+        size = 0
+        matched = 0
+        self.emitted = 0
+        self.decode_time = 0
+        self.wait_time = 0
+        state = self.init() if self.init is not None else None
+        rows = []
+        records = _RecordBuffer(
+            JSONDecoder(), MAX_JSON, self.line_decoder, self.prefilter, self.project
+        )
+        async for row, line in self._records(key, chunks, records):
+            lines += 1
+            size += len(line)
+            if self.row_filter is not None and not self.row_filter(row):
+                continue
+            matched += 1
+            if self.handle_batch is not None:
+                rows.append(row)
+                if len(rows) >= self.batch_size:
+                    state = self._call_batch(rows, state)
+                    rows = []
+                continue
+            if self.init is not None:
+                result = self.handle_row(row, line, state)
+                if result is not None:
+                    state = result
+                continue
+            output = self.handle_row(row, line)
+            if output:
+                self._emit(output)
+        if rows:
+            state = self._call_batch(rows, state)
+        if self.sink is not None:
+            self.sink.end_object()
+        lines += records.skipped
+        size += records.skipped_size
+        self.matched = matched
+        self.decode_errors = records.errors
+        self.handler_time = max(
+            time.perf_counter() - started - self.decode_time - self.wait_time, 0
+        )
+        return lines, size, state
+
+
+async def worker(loop, handler, stdin=None, stdout=None):
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), stdin or sys.stdin
+    )
+    stdout = stdout or sys.stdout.buffer
+    write_frame(stdout, FRAME_HELLO, HELLO.pack(PROTOCOL_VERSION))
+    try:
+        while True:
+            key, chunks = await read_object(reader, handler.ring)
+            if handler.capture:
+                handler.output = io.StringIO()
+            try:
+                lines, size, state = await handler.process(key, chunks)
+            except (EOFError, ConnectionError):
+                raise
+            except Exception:
+                # the object failed, not the worker: skip the rest of it
+                async for _ in chunks:
+                    pass
+                if handler.sink is not None:
+                    handler.sink.discard_object()
+                write_frame(stdout, FRAME_ERROR, traceback.format_exc().encode())
+                continue
+            # partial aggregates go back per object so they can be checkpointed
+            payload = pickle.dumps(state) if handler.init is not None else b""
+            output = b""
+            if handler.capture:
+                output = handler.output.getvalue().encode(errors="surrogateescape")
+            counters = RESULT.pack(
+                lines,
+                size,
+                handler.matched,
+                handler.emitted,
+                handler.decode_errors,
+                handler.decode_time,
+                handler.handler_time,
+                len(payload),
+                len(output),
+            )
+            write_frame(stdout, FRAME_RESULT, counters, payload, output)
     except EOFError:
         pass
+    if handler.sink is not None:
+        handler.sink.close()
+
+
+def make_handler(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("script")
+    parser.add_argument("--row-time")
+    parser.add_argument("--since")
+    parser.add_argument("--until")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument(
+        "--decoder", choices=["auto", "json", *LINE_DECODERS], default="auto"
+    )
+    parser.add_argument("--capture-output", action="store_true")
+    parser.add_argument("--ring")
+    parser.add_argument("--output")
+    parser.add_argument(
+        "--output-format", choices=["ndjson", "parquet"], default="ndjson"
+    )
+    parser.add_argument(
+        "--output-compression", choices=["none", "gzip", "zstd"], default="none"
+    )
+    args = parser.parse_args(argv)
+
+    module = importlib.import_module(args.script)
+    row_filter = None
+    if args.row_time:
+        row_filter = time_filter(args.row_time, args.since, args.until)
+    fields = declared_fields(module, args.row_time)
+    handler = Handler(
+        module,
+        row_filter,
+        args.batch_size,
+        line_decoder(args.decoder, fields),
+        fields,
+    )
+    handler.capture = args.capture_output
+    if args.ring:
+        handler.ring = Ring(args.ring)
+    if args.output:
+        handler.sink = ShardWriter(
+            args.output, args.output_format, args.output_compression
+        )
+    return handler
 
 
 def worker_main():
-    script_module = sys.argv[1]
-    handle_row = getattr(importlib.import_module(script_module), "handle_row")
+    handler = make_handler()
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(worker(loop, handle_row))
+    loop.run_until_complete(worker(loop, handler))
+
+
+def forked_worker_main(argv, stdin, stdout):
+    """
+    Entry point of workers forked from a forkserver, which has the script
+    imported already. ``argv`` are the command line arguments of
+    ``worker_main``, and ``stdin``/``stdout`` the pipe connections to the
+    parent.
+    """
+    # script output goes to the parent's stdout, as for subprocess workers
+    os.dup2(sys.stdout.fileno(), sys.stderr.fileno())
+    handler = make_handler(argv)
+    stdin_file = os.fdopen(os.dup(stdin.fileno()), "rb", buffering=0)
+    stdout_file = os.fdopen(os.dup(stdout.fileno()), "wb")
+    stdin.close()
+    stdout.close()
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(worker(loop, handler, stdin_file, stdout_file))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,364 @@
+"""
+Where s3log finds the logs and reads them from.
+
+A source lists objects as dicts with the ``Key``, ``Size`` and ``ETag`` of a
+ListObjectsV2 result, and streams the bytes of one of them. It is used as an
+async context manager holding its connections for the duration of a run.
+"""
+
+import asyncio
+import collections
+import contextlib
+import csv
+import glob
+import gzip
+import io
+import json
+import os
+from urllib.parse import unquote_plus, urlparse
+
+from aiobotocore.session import get_session
+
+from gen3utils.s3log.s3log_worker import read_file
+
+
+class Source:
+    """
+    Objects to process. ``name`` identifies the source in checkpoints, so
+    keys are only skipped when they were processed from the same source.
+    ``requests`` counts the requests made, by operation and status.
+    """
+
+    name = None
+
+    def __init__(self):
+        self.requests = collections.Counter()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def list(self, enqueue, in_window, start_after=None):
+        """
+        Call ``await enqueue(entry)`` for each object under the prefix, only
+        the keys after ``start_after`` when given. ``in_window(prefix)`` is
+        False for prefixes that cannot hold keys in the time window, which do
+        not need listing.
+        """
+        raise NotImplementedError
+
+    def read(self, key, start=None, end=None):
+        """
+        Async generator of the bytes of ``key``, only the range [start, end)
+        when given. Callers stopping early should close it with
+        ``contextlib.aclosing`` to release the connection or file.
+        """
+        raise NotImplementedError
+
+
+class S3Source(Source):
+    """
+    Objects under an S3 prefix, listed with ``listers`` concurrent
+    ListObjectsV2 requests over the sub-prefixes found down to
+    ``list_depth`` levels.
+    """
+
+    def __init__(
+        self,
+        bucket,
+        prefix,
+        region,
+        access_key_id,
+        secret_access_key,
+        listers,
+        list_depth,
+    ):
+        super().__init__()
+        self.name = bucket
+        self._bucket = bucket
+        self._prefix = prefix
+        self._region = region
+        self._access_key_id = access_key_id
+        self._secret_access_key = secret_access_key
+        self._listers = listers
+        self._list_depth = list_depth
+        self._client = None
+        self._exit_stack = None
+
+    def __str__(self):
+        return f"{self._bucket}/{self._prefix} in {self._region}"
+
+    async def __aenter__(self):
+        self._exit_stack = contextlib.AsyncExitStack()
+        self._client = await self._exit_stack.enter_async_context(
+            get_session().create_client(
+                "s3",
+                region_name=self._region,
+                aws_secret_access_key=self._secret_access_key,
+                aws_access_key_id=self._access_key_id,
+            )
+        )
+        self._client.meta.events.register("after-call.s3", self._count_request)
+        return self
+
+    def _count_request(self, model, http_response, **kwargs):
+        self.requests[model.name, http_response.status_code] += 1
+
+    async def __aexit__(self, *exc_info):
+        self._client = None
+        await self._exit_stack.__aexit__(*exc_info)
+
+    async def _list_prefixes(self, prefixes, enqueue, in_window):
+        paginator = self._client.get_paginator("list_objects_v2")
+        while True:
+            prefix, depth = await prefixes.get()
+            kwargs = {}
+            if depth < self._list_depth:
+                # discover sub-prefixes (e.g. date partitions) to list them in parallel
+                kwargs["Delimiter"] = "/"
+            async for result in paginator.paginate(
+                Bucket=self._bucket, Prefix=prefix, **kwargs
+            ):
+                for p in result.get("CommonPrefixes", []):
+                    if in_window(p["Prefix"]):
+                        prefixes.put_nowait((p["Prefix"], depth + 1))
+                for c in result.get("Contents", []):
+                    await enqueue(c)
+            prefixes.task_done()
+
+    async def list(self, enqueue, in_window, start_after=None):
+        if start_after is not None:
+            # S3 would also skip the sub-prefixes sorting before the mark,
+            # even if they hold later keys, so list the few new keys flat
+            paginator = self._client.get_paginator("list_objects_v2")
+            async for result in paginator.paginate(
+                Bucket=self._bucket, Prefix=self._prefix, StartAfter=start_after
+            ):
+                for c in result.get("Contents", []):
+                    await enqueue(c)
+            return
+        prefixes = asyncio.Queue()
+        prefixes.put_nowait((self._prefix, 0))
+        await _drain(
+            prefixes,
+            [
+                self._list_prefixes(prefixes, enqueue, in_window)
+                for _ in range(self._listers)
+            ],
+        )
+
+    async def read(self, key, start=None, end=None):
+        kwargs = {}
+        if start is not None:
+            kwargs["Range"] = f"bytes={start}-{end - 1}"
+        response = await self._client.get_object(Bucket=self._bucket, Key=key, **kwargs)
+        # this will ensure the connection is correctly re-used/closed
+        async with response["Body"] as stream:
+            while True:
+                chunk = await stream.readany()
+                if not chunk:
+                    return
+                yield chunk
+
+
+async def _drain(queue, workers):
+    """
+    Run ``workers`` until all the items put in ``queue``, including the ones
+    they put themselves, are done, or until one of them raises.
+    """
+    loop = asyncio.get_running_loop()
+    tasks = [loop.create_task(worker) for worker in workers]
+    joined = loop.create_task(queue.join())
+    try:
+        await asyncio.wait([joined, *tasks], return_when=asyncio.FIRST_COMPLETED)
+        # workers only ever return by raising
+        for task in tasks:
+            if task.done():
+                task.result()
+    finally:
+        for task in [joined, *tasks]:
+            task.cancel()
+
+
+def _inventory_csv(data, schema):
+    """
+    Rows of a gzipped CSV inventory file. Keys are URL-encoded in this format.
+    """
+    column = {name: i for i, name in enumerate(schema)}
+    with io.TextIOWrapper(gzip.GzipFile(fileobj=io.BytesIO(data)), newline="") as f:
+        for row in csv.reader(f):
+            if "IsLatest" in column and row[column["IsLatest"]] != "true":
+                continue
+            if "IsDeleteMarker" in column and row[column["IsDeleteMarker"]] == "true":
+                continue
+            yield {
+                "Key": unquote_plus(row[column["Key"]]),
+                "Size": int(row[column["Size"]]),
+                "ETag": f'"{row[column["ETag"]]}"' if "ETag" in column else None,
+            }
+
+
+def _inventory_parquet(data, schema):
+    """
+    Rows of a Parquet inventory file, read with ``pyarrow``.
+    """
+    try:
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError(
+            f"{e}: reading Parquet inventories needs the pyarrow package"
+        ) from e
+
+    table = pyarrow.parquet.read_table(io.BytesIO(data))
+    columns = set(table.column_names)
+    for row in table.to_pylist():
+        if "is_latest" in columns and not row["is_latest"]:
+            continue
+        if "is_delete_marker" in columns and row["is_delete_marker"]:
+            continue
+        etag = row.get("e_tag")
+        yield {
+            "Key": row["key"],
+            "Size": row["size"],
+            "ETag": f'"{etag}"' if etag is not None else None,
+        }
+
+
+INVENTORY_FORMATS = {"CSV": _inventory_csv, "Parquet": _inventory_parquet}
+
+
+class InventorySource(S3Source):
+    """
+    Objects under an S3 prefix, listed from the S3 Inventory report whose
+    ``manifest.json`` is at the ``s3://`` URL ``manifest`` instead of with
+    ListObjectsV2, which takes hours for billions of keys. The report is as
+    old as its last daily or weekly run, so newer objects are missing and
+    deleted ones fail to fetch. Objects are read from S3 as usual.
+    """
+
+    def __init__(self, manifest, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        url = urlparse(manifest)
+        if url.scheme != "s3":
+            raise ValueError(f"Inventory manifest must be an s3:// URL: {manifest}")
+        self._manifest_bucket = url.netloc
+        self._manifest_key = url.path.lstrip("/")
+
+    def __str__(self):
+        return (
+            f"{super().__str__()}, listed by "
+            f"s3://{self._manifest_bucket}/{self._manifest_key}"
+        )
+
+    async def _get(self, bucket, key):
+        response = await self._client.get_object(Bucket=bucket, Key=key)
+        async with response["Body"] as stream:
+            return await stream.read()
+
+    async def _list_files(self, files, destination, parse, schema, enqueue, in_window):
+        while True:
+            key = await files.get()
+            for entry in parse(await self._get(destination, key), schema):
+                if entry["Key"].startswith(self._prefix) and in_window(entry["Key"]):
+                    await enqueue(entry)
+            files.task_done()
+
+    async def list(self, enqueue, in_window, start_after=None):
+        if start_after is not None:
+            raise ValueError("An inventory is a snapshot, it cannot be followed")
+        manifest = json.loads(
+            await self._get(self._manifest_bucket, self._manifest_key)
+        )
+        if manifest["sourceBucket"] != self._bucket:
+            raise ValueError(
+                f"Inventory {self._manifest_key} is for bucket "
+                f"{manifest['sourceBucket']}, not {self._bucket}"
+            )
+        parse = INVENTORY_FORMATS.get(manifest["fileFormat"])
+        if parse is None:
+            raise ValueError(
+                f"Unsupported inventory format {manifest['fileFormat']}, "
+                f"use one of {', '.join(INVENTORY_FORMATS)}"
+            )
+        schema = [name.strip() for name in manifest["fileSchema"].split(",")]
+        # "arn:aws:s3:::bucket"
+        destination = manifest["destinationBucket"].rsplit(":", 1)[-1]
+        files = asyncio.Queue()
+        for f in manifest["files"]:
+            files.put_nowait(f["key"])
+        await _drain(
+            files,
+            [
+                self._list_files(files, destination, parse, schema, enqueue, in_window)
+                for _ in range(self._listers)
+            ],
+        )
+
+
+class LocalSource(Source):
+    """
+    Files in a local directory, keyed by their path relative to it with
+    ``/`` separators, or matching a glob pattern (``**`` for any number of
+    directories), keyed by the matched path. Files are memory-mapped, so
+    logs downloaded once can be processed again at disk speed.
+    """
+
+    def __init__(self, path, prefix):
+        super().__init__()
+        self._path = path
+        self._prefix = prefix
+        self._directory = os.path.isdir(path)
+        self.name = os.path.abspath(path) if self._directory else path
+
+    def __str__(self):
+        return f"{os.path.join(self._path, self._prefix)} on disk"
+
+    def _entry(self, key, path):
+        stat = os.stat(path)
+        # no content hash to compare, but a rewritten file changes either
+        return {
+            "Key": key,
+            "Size": stat.st_size,
+            "ETag": f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"',
+        }
+
+    def _walk(self, in_window):
+        if not self._directory:
+            for path in glob.glob(self._path, recursive=True):
+                if path.startswith(self._prefix) and os.path.isfile(path):
+                    yield self._entry(path, path)
+            return
+        for root, dirs, files in os.walk(self._path):
+            relative = os.path.relpath(root, self._path).replace(os.sep, "/")
+            base = "" if relative == "." else relative + "/"
+            dirs[:] = [
+                d
+                for d in dirs
+                if (
+                    (base + d + "/").startswith(self._prefix)
+                    or self._prefix.startswith(base + d + "/")
+                )
+                and in_window(base + d + "/")
+            ]
+            for name in files:
+                if (base + name).startswith(self._prefix):
+                    yield self._entry(base + name, os.path.join(root, name))
+
+    async def list(self, enqueue, in_window, start_after=None):
+        # in key order like S3, walking in a thread to keep the event loop free
+        entries = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: sorted(self._walk(in_window), key=lambda e: e["Key"])
+        )
+        for entry in entries:
+            if start_after is None or entry["Key"] > start_after:
+                await enqueue(entry)
+
+    def _file(self, key):
+        if self._directory:
+            return os.path.join(self._path, *key.split("/"))
+        return key
+
+    def read(self, key, start=None, end=None):
+        return read_file(self._file(key), start, end)
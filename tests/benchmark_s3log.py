@@ -0,0 +1,84 @@
+"""
+Compare rows/s of handle_row and handle_batch scripts on the same synthetic
+log, counting server errors per path. Both include JSON decoding,
+which usually dominates; the best of a few runs is reported. Run with:
+
+    python -m tests.benchmark_s3log [ROWS] [BATCH_SIZE]
+"""
+
+import asyncio
+import collections
+import json
+import random
+import sys
+import time
+import types
+
+from gen3utils.s3log.s3log_worker import DEFAULT_BATCH_SIZE, Handler
+
+
+def _log(count):
+    random.seed(42)
+    rows = []
+    for i in range(count):
+        rows.append(
+            json.dumps(
+                {
+                    "timestamp": 1700000000 + i,
+                    "http_status_code": random.choice([200, 200, 200, 404, 500]),
+                    "request": {"path": f"/user/data/{random.randint(0, 99)}"},
+                    "user_id": random.randint(0, 999),
+                }
+            )
+        )
+    return "\n".join(rows).encode()
+
+
+def _handle_row(obj, line, counts):
+    if obj["http_status_code"] >= 500:
+        counts[obj["request"]["path"]] += 1
+
+
+def _handle_batch(rows, counts):
+    counts.update(
+        path
+        for status, path in zip(rows["http_status_code"], rows["request.path"])
+        if status >= 500
+    )
+
+
+async def _chunks(data, chunk_size=65536):
+    for i in range(0, len(data), chunk_size):
+        yield data[i : i + chunk_size]
+
+
+def _run(module, data, batch_size, repeat=3):
+    handler = Handler(module, batch_size=batch_size)
+    best = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        lines, _, counts = asyncio.run(handler.process("bench.json", _chunks(data)))
+        best = max(best, lines / (time.perf_counter() - start))
+    return best, counts
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_BATCH_SIZE
+    data = _log(count)
+    rows = types.SimpleNamespace(init=collections.Counter, handle_row=_handle_row)
+    batch = types.SimpleNamespace(
+        init=collections.Counter,
+        handle_batch=_handle_batch,
+        BATCH_FIELDS=["http_status_code", "request.path"],
+    )
+    row_speed, row_counts = _run(rows, data, batch_size)
+    batch_speed, batch_counts = _run(batch, data, batch_size)
+    assert row_counts == batch_counts
+    print(f"{count:,} rows, {len(data) / 1024 / 1024:.1f}MiB")
+    print(f"handle_row:   {row_speed:,.0f} rows/s")
+    print(f"handle_batch: {batch_speed:,.0f} rows/s (batches of {batch_size})")
+
+
+if __name__ == "__main__":
+    main()
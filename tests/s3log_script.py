@@ -0,0 +1,21 @@
+"""
+Handler script for the s3log worker tests.
+"""
+
+import os
+
+
+def init():
+    return 0
+
+
+def merge(a, b):
+    return a + b
+
+
+def handle_row(obj, line, count):
+    if "exit" in obj:
+        os._exit(obj["exit"])
+    if "raise" in obj:
+        raise ValueError(obj["raise"])
+    return count + 1
@@ -0,0 +1,1264 @@
+import asyncio
+import collections
+import contextlib
+import glob
+import gzip
+import json
+import multiprocessing
+import os
+import pickle
+import random
+import re
+import tempfile
+import types
+from datetime import datetime, timezone
+
+import pytest
+
+from gen3utils.s3log import merge, metrics, s3log_worker, sources
+from gen3utils.s3log.s3log import (
+    DEFAULT_KEY_TIME,
+    RANGE_SLACK,
+    S3Log,
+    _balanced_shard,
+    _Checkpoint,
+    _ChunkBuffer,
+    _ForkedWorker,
+    _key_shard,
+    _key_time_range,
+    _LargestFirstQueue,
+    _Object,
+    _ObjectCache,
+    _parse_shard,
+    _RangeTrimmer,
+    _ResultCache,
+    _unitize,
+)
+from gen3utils.s3log.s3log_worker import (
+    CHUNK_HEADER,
+    FRAME_ERROR,
+    FRAME_HELLO,
+    FRAME_RESULT,
+    HELLO,
+    OBJECT_HEADER,
+    PROTOCOL_VERSION,
+    RESULT,
+    Handler,
+    Ring,
+    ShardWriter,
+    decompress,
+    line_decoder,
+    prefilter_matcher,
+    projection,
+    read_frame,
+    stream_json,
+    time_filter,
+)
+
+S3LOG_CORPUS = ["tests/data/s3log/fence.json", "tests/data/s3log/edge_cases.json"]
+
+
+def _records(count=100):
+    random.seed(42)
+    records = []
+    for i in range(count):
+        records.append(
+            {
+                "i": i,
+                "path": "/user/data/" + "x" * random.randint(0, 200),
+                "nested": {"list": [{"a": 1}, {"b": {"c": "}{"[: i % 2]}}]},
+                "message": ['payload} {"x": 1}', "}\n{", '} "{'][i % 3],
+            }
+        )
+    return records
+
+
+def _fetch_range(data, start, end, chunk_size):
+    fetch_start = max(start - 1, 0)
+    fetch_end = min(end + RANGE_SLACK, len(data))
+    trimmer = _RangeTrimmer(
+        start > 0, end - 1 - fetch_start if end < len(data) else None
+    )
+    out = b""
+    for pos in range(fetch_start, fetch_end, chunk_size):
+        out += trimmer.feed(data[pos : min(pos + chunk_size, fetch_end)])
+        if trimmer.done:
+            return out
+    return out
+
+
+@pytest.mark.parametrize("separator", ["\n", "\r\n", " \n\t "])
+@pytest.mark.parametrize("range_size", [1, 97, 65536])
+@pytest.mark.parametrize("chunk_size", [7, 65536])
+def test_range_trimmer_splits_on_record_boundaries(separator, range_size, chunk_size):
+    records = _records()
+    data = separator.join(json.dumps(r) for r in records).encode()
+    decoded = []
+    for start in range(0, len(data), range_size):
+        end = min(start + range_size, len(data))
+        part = _fetch_range(data, start, end, chunk_size).decode()
+        decoder = json.JSONDecoder()
+        pos = 0
+        while part[pos:].strip():
+            obj, pos = decoder.raw_decode(part, len(part) - len(part[pos:].lstrip()))
+            decoded.append(obj)
+    assert decoded == records
+
+
+async def _aiter(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def _stream(key, data, chunk_size=1000):
+    async def collect():
+        chunks = [data[i : i + chunk_size] for i in range(0, len(data), chunk_size)]
+        return [obj async for obj, _ in stream_json(decompress(key, _aiter(chunks)))]
+
+    return asyncio.run(collect())
+
+
+@pytest.mark.parametrize(
+    "key,compress",
+    [
+        ("logs/a.json", lambda data: data),
+        ("logs/a.json.gz", gzip.compress),
+        # detected from the magic bytes
+        ("logs/a", gzip.compress),
+        # concatenated gzip members
+        (
+            "logs/a.gz",
+            lambda data: gzip.compress(data[:1000]) + gzip.compress(data[1000:]),
+        ),
+    ],
+)
+def test_decompress(key, compress):
+    records = _records()
+    data = "\n".join(json.dumps(r) for r in records).encode()
+    assert _stream(key, compress(data)) == records
+
+
+@pytest.mark.parametrize("separator", ["\n", "", " \n\t ", "\r\n"])
+@pytest.mark.parametrize("chunk_size", [1, 7, 1000, 65536])
+@pytest.mark.parametrize("indent", [None, 2])
+def test_stream_json(separator, chunk_size, indent):
+    records = _records()
+    for r in records:
+        r["name"] = "caf\u00e9 \u6e2c\u8a66 \U0001f600"
+    lines = [json.dumps(r, indent=indent, ensure_ascii=False) for r in records]
+    data = separator.join(lines).encode()
+    chunks = [data[i : i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+    async def collect():
+        return [pair async for pair in stream_json(_aiter(chunks))]
+
+    assert asyncio.run(collect()) == list(zip(records, lines))
+
+
+def test_stream_json_skips_bad_lines(capsys):
+    data = b'{"a": 1}\nnot json\n{"b": \n{"c": 3}\n{"d": 4}'
+
+    async def collect():
+        return [obj async for obj, _ in stream_json(_aiter([data[:12], data[12:]]))]
+
+    assert asyncio.run(collect()) == [{"a": 1}, {"c": 3}, {"d": 4}]
+    assert "Cannot get JSON" in capsys.readouterr().err
+
+
+def _decode_all(data, chunk_size, line_decoder):
+    chunks = [data[i : i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+    async def collect():
+        return [
+            pair
+            async for pair in stream_json(_aiter(chunks), line_decoder=line_decoder)
+        ]
+
+    return asyncio.run(collect())
+
+
+@pytest.fixture(params=["orjson", "msgspec", "json.loads"])
+def fast_decoder(request):
+    if request.param == "json.loads":
+        # exercises the line path without the optional parsers
+        return json.loads, ValueError
+    pytest.importorskip(request.param)
+    return line_decoder(request.param)
+
+
+@pytest.mark.parametrize("path", S3LOG_CORPUS)
+@pytest.mark.parametrize("chunk_size", [1, 13, 65536])
+def test_line_decoder_parity(fast_decoder, path, chunk_size, capsys):
+    with open(path, "rb") as f:
+        data = f.read()
+    expected = _decode_all(data, chunk_size, None)
+    # error positions depend on where scanning started, not the reported records
+    expected_err = capsys.readouterr().err.count("Cannot get JSON")
+    assert _decode_all(data, chunk_size, fast_decoder) == expected
+    assert capsys.readouterr().err.count("Cannot get JSON") == expected_err
+
+
+@pytest.mark.parametrize(
+    "prefilter",
+    [b"alice", "b\\u00f6b", re.compile(rb'"http_status_code": 5\d\d')],
+)
+@pytest.mark.parametrize("separator", [b"\n", b""])
+@pytest.mark.parametrize("loads", [None, (json.loads, ValueError)])
+def test_prefilter(prefilter, separator, loads):
+    with open(S3LOG_CORPUS[0], "rb") as f:
+        data = separator.join(f.read().splitlines())
+    matches = prefilter_matcher(prefilter)
+    expected = [
+        (obj, line)
+        for obj, line in _decode_all(data, 1000, None)
+        if matches(line.encode())
+    ]
+    assert 0 < len(expected) < 100
+
+    async def collect():
+        return [
+            pair
+            async for pair in stream_json(
+                _aiter([data[i : i + 1000] for i in range(0, len(data), 1000)]),
+                line_decoder=loads,
+                prefilter=matches,
+            )
+        ]
+
+    assert asyncio.run(collect()) == expected
+
+    handler = Handler(
+        types.SimpleNamespace(PREFILTER=prefilter, handle_row=lambda obj, line: None),
+        line_decoder=loads,
+    )
+    lines, _, _ = asyncio.run(handler.process("logs/a.json", _aiter([data])))
+    assert lines == 200
+
+
+def test_projection():
+    project = projection(["a", "b.c", "b.d.e", "f", "f.g", "missing.x"])
+    row = {"a": 1, "b": {"c": [2], "d": "not an object", "z": 0}, "f": {"g": 1, "h": 2}}
+    assert project(row) == {"a": 1, "b": {"c": [2]}, "f": {"g": 1, "h": 2}}
+    assert project({"b": None}) == {}
+    assert project([1, 2]) == [1, 2]
+
+
+@pytest.mark.parametrize("decoder", ["json", "orjson", "msgspec"])
+@pytest.mark.parametrize("path", S3LOG_CORPUS)
+def test_fields(decoder, path):
+    if decoder != "json":
+        pytest.importorskip(decoder)
+    with open(path, "rb") as f:
+        data = f.read()
+    fields = ["timestamp", "request.path", "user_id", "über.kéy", "nested.list"]
+    project = projection(fields)
+    expected = [project(obj) for obj, _ in _decode_all(data, 1000, None)]
+
+    module = types.SimpleNamespace(
+        FIELDS=fields,
+        init=list,
+        handle_row=lambda obj, line, rows: rows.append(obj),
+    )
+    handler = Handler(module, line_decoder=line_decoder(decoder, fields), fields=fields)
+    _, _, rows = asyncio.run(handler.process("logs/a.json", _aiter([data])))
+    assert rows == expected
+
+
+def test_line_decoder_auto(monkeypatch):
+    def fake(name):
+        return lambda fields: (name, fields)
+
+    monkeypatch.setattr(
+        s3log_worker,
+        "LINE_DECODERS",
+        {"orjson": fake("orjson"), "msgspec": fake("msgspec")},
+    )
+    assert line_decoder("auto") == ("orjson", None)
+    assert line_decoder("auto", ["a.b"]) == ("msgspec", ["a.b"])
+    assert line_decoder("orjson", ["a.b"]) == ("orjson", ["a.b"])
+    assert line_decoder("json", ["a.b"]) is None
+
+
+def test_checkpoint(tmp_path):
+    path = str(tmp_path / "checkpoint.db")
+    checkpoint = _Checkpoint(path, "bucket", "script")
+    checkpoint.record("logs/a.json", '"etag-a"', 100, 2, 98)
+    checkpoint.record("logs/b.json", '"etag-b"', 100, 2, 98, b"partial")
+    checkpoint.set_mark("logs/", "logs/b.json")
+    checkpoint.close()
+
+    checkpoint = _Checkpoint(path, "bucket", "script")
+    assert checkpoint.count() == 2
+    assert checkpoint.lookup("logs/a.json", '"etag-a"') == b""
+    assert checkpoint.lookup("logs/b.json", '"etag-b"') == b"partial"
+    assert checkpoint.mark("logs/") == "logs/b.json"
+    # overwritten since the last run
+    assert checkpoint.lookup("logs/a.json", '"etag-b"') is None
+    assert checkpoint.lookup("logs/c.json", '"etag-a"') is None
+    other = _Checkpoint(path, "other-bucket", "script")
+    assert other.lookup("logs/a.json", '"etag-a"') is None
+    # another script's partials are not this one's
+    other = _Checkpoint(path, "bucket", "other-script")
+    assert other.count() == 0
+    assert other.lookup("logs/b.json", '"etag-b"') is None
+    assert other.mark("logs/") is None
+
+
+def test_result_cache(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = _ResultCache(path, "bucket", "script-a", 100)
+    cache.store("logs/a.json", '"etag-a"', 2, 98, b"partial", b"row\n" * 10)
+    cache.store("logs/b.json", '"etag-b"', 2, 98, b"", b"x" * 50)
+    cache.store("logs/c.json", None, 2, 98, b"", b"")
+    cache.close()
+
+    cache = _ResultCache(path, "bucket", "script-a", 100)
+    assert cache.lookup("logs/a.json", '"etag-a"') == (2, 98, b"partial", b"row\n" * 10)
+    assert cache.lookup("logs/a.json", '"etag-b"') is None
+    assert cache.lookup("logs/c.json", None) is None
+    assert (
+        _ResultCache(path, "bucket", "script-b", 100).lookup("logs/a.json", '"etag-a"')
+        is None
+    )
+    # b was used least recently
+    cache.store("logs/d.json", '"etag-d"', 1, 1, b"", b"y" * 30)
+    assert cache.lookup("logs/b.json", '"etag-b"') is None
+    assert cache.lookup("logs/a.json", '"etag-a"') is not None
+    assert cache.lookup("logs/d.json", '"etag-d"') is not None
+    assert cache.hits == 3
+
+
+def test_key_time_range():
+    pattern = re.compile(DEFAULT_KEY_TIME)
+    assert _key_time_range(pattern, "logs/2024/01/31/fence.json.gz") == (
+        datetime(2024, 1, 31, tzinfo=timezone.utc),
+        datetime(2024, 2, 1, tzinfo=timezone.utc),
+    )
+    assert _key_time_range(pattern, "logs/2024-12-31-23-stream-1.json") == (
+        datetime(2024, 12, 31, 23, tzinfo=timezone.utc),
+        datetime(2025, 1, 1, tzinfo=timezone.utc),
+    )
+    assert _key_time_range(pattern, "logs/latest.json") is None
+    day = (
+        datetime(2024, 1, 31, tzinfo=timezone.utc),
+        datetime(2024, 2, 1, tzinfo=timezone.utc),
+    )
+    assert _key_time_range(pattern, "logs/2024/01/31/12345.json") == day
+    assert _key_time_range(pattern, "logs/2024-01-31/09876.log.gz") == day
+    assert _key_time_range(pattern, "logs/2024/01/31/09/") == (
+        datetime(2024, 1, 31, 9, tzinfo=timezone.utc),
+        datetime(2024, 1, 31, 10, tzinfo=timezone.utc),
+    )
+    assert _key_time_range(pattern, "logs/2024/01/31/09") == (
+        datetime(2024, 1, 31, 9, tzinfo=timezone.utc),
+        datetime(2024, 1, 31, 10, tzinfo=timezone.utc),
+    )
+    assert _key_time_range(pattern, "logs/build-1234-56-78.json") is None
+    assert _key_time_range(pattern, "logs/2024/02/30/") is None
+
+    monthly = re.compile(r"(?P<year>\d{4})/(?P<month>\d{2})/")
+    assert _key_time_range(monthly, "logs/2024/12/") == (
+        datetime(2024, 12, 1, tzinfo=timezone.utc),
+        datetime(2025, 1, 1, tzinfo=timezone.utc),
+    )
+
+
+def test_time_filter():
+    accept = time_filter("request.time", "2024-01-02T00:00:00", "2024-01-03")
+    assert accept({"request": {"time": "2024-01-02T12:00:00Z"}})
+    assert accept(
+        {"request": {"time": datetime(2024, 1, 2, 5, tzinfo=timezone.utc).timestamp()}}
+    )
+    assert not accept({"request": {"time": "2024-01-01T23:59:59+00:00"}})
+    assert not accept({"request": {"time": "2024-01-02T23:00:00-05:00"}})
+    # no usable timestamp: left to the script
+    assert accept({"request": {"time": "yesterday"}})
+    assert accept({"request": "GET /"})
+    assert accept({})
+
+
+@pytest.mark.parametrize("batch_size", [1, 7, 1000])
+def test_handle_batch(batch_size):
+    records = _records()
+    data = "\n".join(json.dumps(r) for r in records).encode()
+
+    def process(module):
+        handler = Handler(module, lambda row: row["i"] % 3, batch_size)
+        return asyncio.run(handler.process("logs/a.json", _aiter([data])))
+
+    rows = types.SimpleNamespace(
+        init=list, handle_batch=lambda rows, seen: seen.extend(r["i"] for r in rows)
+    )
+    lines, size, seen = process(rows)
+    assert lines == len(records)
+    assert size == len(data) - len(records) + 1
+    assert seen == [r["i"] for r in records if r["i"] % 3]
+
+    columns = types.SimpleNamespace(
+        BATCH_FIELDS=["i", "nested.list", "missing.field"],
+        init=list,
+        handle_batch=lambda cols, seen: seen + [cols],
+    )
+    _, _, batches = process(columns)
+    assert all(len(batch["i"]) <= batch_size for batch in batches)
+    assert [i for batch in batches for i in batch["i"]] == seen
+    assert all(v is None for batch in batches for v in batch["missing.field"])
+
+    class Outputs(list):
+        # like numpy arrays or pandas series
+        def __bool__(self):
+            raise ValueError("The truth value of an array is ambiguous")
+
+    emitted = []
+    outputs = types.SimpleNamespace(
+        handle_batch=lambda rows: Outputs(str(r["i"]) for r in rows)
+    )
+    handler = Handler(outputs, lambda row: row["i"] % 3, batch_size)
+    handler._emit = emitted.append
+    asyncio.run(handler.process("logs/a.json", _aiter([data])))
+    assert emitted == [str(i) for i in seen]
+
+
+@pytest.mark.parametrize("compression", ["none", "gzip"])
+def test_shard_writer(tmp_path, compression):
+    sink = ShardWriter(str(tmp_path), "ndjson", compression)
+    module = types.SimpleNamespace(
+        handle_row=lambda obj, line: obj if obj["i"] % 2 else line
+    )
+    handler = Handler(module)
+    handler.sink = sink
+    sink.write("first")
+    # rows are only written once their object is done
+    assert not list(tmp_path.iterdir())
+    sink.end_object()
+    records = _records(10)
+    data = "\n".join(json.dumps(r) for r in records).encode()
+    asyncio.run(handler.process("logs/a.json", _aiter([data])))
+    sink.close()
+
+    (shard,) = tmp_path.iterdir()
+    content = shard.read_bytes()
+    if compression == "gzip":
+        assert shard.name.endswith(".ndjson.gz")
+        # one gzip member per object
+        content = gzip.decompress(content)
+    assert [json.loads(line) for line in content.splitlines()[1:]] == records
+    assert content.splitlines()[0] == b"first"
+
+
+def test_shard_writer_large_object(tmp_path, monkeypatch):
+    monkeypatch.setattr(s3log_worker, "OBJECT_ROWS", 3)
+    sink = ShardWriter(str(tmp_path), "ndjson", "gzip")
+    for i in range(5):
+        sink.write({"i": i})
+    sink.discard_object()
+    assert not list(tmp_path.iterdir())
+
+    sink.write("small")
+    sink.end_object()
+    (small,) = tmp_path.iterdir()
+    for i in range(10):
+        sink.write({"i": i})
+        # batches go to a temporary file, never seen as a shard
+        assert all(p == small or p.name.endswith(".tmp") for p in tmp_path.iterdir())
+    sink.end_object()
+    sink.close()
+
+    shards = sorted(tmp_path.iterdir())
+    assert not any(p.name.endswith(".tmp") for p in shards)
+    contents = [gzip.decompress(p.read_bytes()).splitlines() for p in shards]
+    assert sorted(contents, key=len) == [
+        [b"small"],
+        [json.dumps({"i": i}).encode() for i in range(10)],
+    ]
+
+
+def test_largest_first_queue():
+    async def run():
+        queue = _LargestFirstQueue(3)
+        for size in [5, 1, 9]:
+            await queue.put(_Object(f"key-{size}", size, None))
+        assert [(await queue.get()).size for _ in range(3)] == [9, 5, 1]
+
+        # held back until the window is full or the listing ends
+        queue = _LargestFirstQueue(3)
+        await queue.put(_Object("a", 1, None))
+        get = asyncio.ensure_future(queue.get())
+        await asyncio.sleep(0)
+        assert not get.done()
+        await queue.put(_Object("b", 2, None))
+        await queue.put(None)
+        assert (await get).size == 2
+        assert (await queue.get()).size == 1
+        assert await queue.get() is None
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("limit", [0, 1, 25])
+def test_chunk_buffer(limit):
+    """
+    Many objects of several chunks through a buffer smaller than one object,
+    with more fetchers than consumers, all get through.
+    """
+
+    async def run():
+        buffer = _ChunkBuffer(limit, 10)
+        keys = asyncio.Queue()
+        for i in range(40):
+            keys.put_nowait(_Object(str(i), 30, None))
+        ready = asyncio.Queue()
+        received = []
+
+        async def fetch():
+            while not keys.empty():
+                obj = keys.get_nowait()
+                for i in range(3):
+                    await buffer.put(obj, b"x" * 10)
+                    if not i:
+                        await ready.put(obj)
+                buffer.close(obj)
+
+        async def consume():
+            while len(received) < 40:
+                obj = await ready.get()
+                buffer.attach(obj)
+                size = 0
+                while (chunk := await buffer.get(obj)) is not None:
+                    size += len(chunk)
+                received.append(size)
+
+        await asyncio.wait_for(
+            asyncio.gather(*(fetch() for _ in range(4)), consume()), 5
+        )
+        assert received == [30] * 40
+        assert buffer.used == 0
+
+    asyncio.run(run())
+
+
+def test_forked_worker(tmp_path):
+    log = tmp_path / "log.json.gz"
+    log.write_bytes(gzip.compress(b'{"a": 1}\n{"a": 2}\n{"a": 3}\n'))
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(["tests.s3log_script"])
+
+    async def send(proc, *chunks):
+        proc.stdin.write(OBJECT_HEADER.pack(1, 0) + b"k")
+        for data in chunks:
+            proc.stdin.write(CHUNK_HEADER.pack(len(data)) + data)
+        proc.stdin.write(CHUNK_HEADER.pack(0))
+        await proc.stdin.drain()
+        return await result(proc)
+
+    async def send_path(proc, path):
+        proc.stdin.write(OBJECT_HEADER.pack(1, len(path)) + b"k" + path)
+        await proc.stdin.drain()
+        return await result(proc)
+
+    async def result(proc):
+        kind, body = await read_frame(proc.stdout)
+        if kind == FRAME_ERROR:
+            return body.decode().splitlines()[-1]
+        assert kind == FRAME_RESULT
+        lines, _, matched, emitted, errors, _, _, size, _ = RESULT.unpack_from(body)
+        assert emitted == 0
+        return lines, matched, errors, pickle.loads(body[RESULT.size :][:size])
+
+    async def run():
+        proc = await _ForkedWorker.start(context, ["tests.s3log_script"])
+        assert await read_frame(proc.stdout) == (
+            FRAME_HELLO,
+            HELLO.pack(PROTOCOL_VERSION),
+        )
+        assert await send(proc, b'{"a": 1}\n{"a": 2}\n') == (2, 2, 0, 2)
+        assert await send(proc, b'{"a": 3}\nnot json\n') == (1, 1, 1, 1)
+        assert await send_path(proc, str(log).encode()) == (3, 3, 0, 3)
+        # the rest of the object is skipped, the worker goes on
+        error = await send(proc, b'{"raise": "bad"}\n', b'{"a": 1}\n')
+        assert error == "ValueError: bad"
+        assert await send(proc, b'{"a": 1}') == (1, 1, 0, 1)
+        with pytest.raises(asyncio.IncompleteReadError):
+            await send(proc, b'{"exit": 3}')
+        assert await proc.wait() == 3
+
+        proc = await _ForkedWorker.start(context, ["tests.s3log_script"])
+        proc.stdin.close()
+        assert await proc.wait() == 0
+
+    asyncio.run(run())
+
+
+def test_ring():
+    writer = Ring.create(16)
+    reader = Ring(writer.path)
+    assert reader.size == 16
+
+    async def run():
+        stdin = asyncio.StreamReader()
+        chunks = reader.read(stdin)
+
+        def send(data):
+            data = memoryview(data)
+            while data:
+                written = writer.write(data)
+                if not written:
+                    return bytes(data)
+                stdin.feed_data(CHUNK_HEADER.pack(written))
+                data = data[written:]
+            return b""
+
+        assert send(b"0123456789") == b""
+        # full until the reader is done with the first chunk
+        assert send(b"abcdefghij") == b"ghij"
+        received = [bytes(await chunks.__anext__())]
+        received.append(bytes(await chunks.__anext__()))
+        # wraps around to the freed start
+        assert send(b"ghij") == b""
+        stdin.feed_data(CHUNK_HEADER.pack(0))
+        received += [bytes(chunk) async for chunk in chunks]
+        return received
+
+    assert asyncio.run(run()) == [b"0123456789", b"abcdef", b"ghij"]
+    reader.close()
+    writer.close()
+    assert not os.path.exists(writer.path)
+
+
+def _collect(source, in_window=lambda prefix: True):
+    async def run():
+        entries = []
+
+        async def enqueue(entry):
+            entries.append(entry)
+
+        async with source:
+            await source.list(enqueue, in_window)
+        return entries
+
+    return asyncio.run(run())
+
+
+def _read(source, key, start=None, end=None):
+    async def run():
+        return b"".join([chunk async for chunk in source.read(key, start, end)])
+
+    return asyncio.run(run())
+
+
+def test_local_source(tmp_path, monkeypatch):
+    monkeypatch.setattr(s3log_worker, "FILE_CHUNK_SIZE", 7)
+    for name in ["2024/01/31/a.json", "2024/02/01/b.json", "2024/02/01/c.json.gz"]:
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_bytes(name.encode() * 10)
+    (tmp_path / "empty.json").write_bytes(b"")
+
+    source = sources.LocalSource(str(tmp_path), "")
+    entries = _collect(source)
+    assert [e["Key"] for e in entries] == [
+        "2024/01/31/a.json",
+        "2024/02/01/b.json",
+        "2024/02/01/c.json.gz",
+        "empty.json",
+    ]
+    assert entries[0]["Size"] == len("2024/01/31/a.json") * 10
+    assert _read(source, "2024/01/31/a.json") == b"2024/01/31/a.json" * 10
+    assert _read(source, "2024/01/31/a.json", 3, 20) == (b"2024/01/31/a.json" * 2)[3:20]
+    assert _read(source, "empty.json") == b""
+
+    source = sources.LocalSource(str(tmp_path), "2024/02")
+    assert [e["Key"] for e in _collect(source)] == [
+        "2024/02/01/b.json",
+        "2024/02/01/c.json.gz",
+    ]
+    source = sources.LocalSource(str(tmp_path), "")
+    entries = _collect(source, lambda prefix: not prefix.startswith("2024/01"))
+    assert [e["Key"] for e in entries] == [
+        "2024/02/01/b.json",
+        "2024/02/01/c.json.gz",
+        "empty.json",
+    ]
+
+    source = sources.LocalSource(str(tmp_path / "**" / "*.json"), "")
+    assert [e["Key"] for e in _collect(source)] == [
+        str(tmp_path / "2024/01/31/a.json"),
+        str(tmp_path / "2024/02/01/b.json"),
+        str(tmp_path / "empty.json"),
+    ]
+
+
+class _StubPaginator:
+    """
+    ListObjectsV2 over ``keys``, two entries per page, recording the
+    requests and raising ``error`` when listing ``failing``.
+    """
+
+    def __init__(self, keys, failing=None, error=None):
+        self.keys = keys
+        self.failing = failing
+        self.error = error
+        self.requests = []
+
+    async def paginate(self, Bucket, Prefix, Delimiter=None):
+        self.requests.append((Prefix, Delimiter))
+        if Prefix == self.failing:
+            raise self.error
+        contents, prefixes = [], []
+        for key in self.keys:
+            if not key.startswith(Prefix):
+                continue
+            rest = key[len(Prefix) :]
+            if Delimiter and Delimiter in rest:
+                prefix = Prefix + rest.split(Delimiter)[0] + Delimiter
+                if {"Prefix": prefix} not in prefixes:
+                    prefixes.append({"Prefix": prefix})
+            else:
+                contents.append({"Key": key, "Size": 1, "ETag": '"etag"'})
+        pages = [
+            {"CommonPrefixes": prefixes[i : i + 2], "Contents": contents[i : i + 2]}
+            for i in range(0, max(len(prefixes), len(contents), 1), 2)
+        ]
+        for page in pages:
+            await asyncio.sleep(0)
+            yield page
+
+
+def _s3_source(monkeypatch, paginator, list_depth):
+    client = types.SimpleNamespace(
+        meta=types.SimpleNamespace(
+            events=types.SimpleNamespace(register=lambda *args: None)
+        ),
+        get_paginator=lambda name: paginator,
+    )
+
+    @contextlib.asynccontextmanager
+    async def create_client(*args, **kwargs):
+        yield client
+
+    session = types.SimpleNamespace(create_client=create_client)
+    monkeypatch.setattr(sources, "get_session", lambda: session)
+    return sources.S3Source("bucket", "logs/", None, None, None, 3, list_depth)
+
+
+def test_s3_source_list(monkeypatch):
+    keys = [
+        "logs/2024/01/31/a.json",
+        "logs/2024/01/31/b.json",
+        "logs/2024/02/01/c.json",
+        "logs/2024/02/02/d.json",
+        "logs/2024/02/02/e.json",
+        "logs/2024/02/02/f.json",
+        "logs/2024/02/02/g/h.json",
+        "logs/top.json",
+    ]
+    paginator = _StubPaginator(keys)
+    entries = _collect(_s3_source(monkeypatch, paginator, 2))
+    assert sorted(e["Key"] for e in entries) == keys
+    # sub-prefixes discovered down to --list-depth, then listed flat
+    assert sorted(paginator.requests) == [
+        ("logs/", "/"),
+        ("logs/2024/", "/"),
+        ("logs/2024/01/", None),
+        ("logs/2024/02/", None),
+    ]
+
+    paginator = _StubPaginator(keys)
+    entries = _collect(
+        _s3_source(monkeypatch, paginator, 3),
+        lambda prefix: not prefix.startswith("logs/2024/01"),
+    )
+    assert sorted(e["Key"] for e in entries) == keys[2:]
+    # pruned prefixes are never listed
+    assert not [p for p, _ in paginator.requests if p.startswith("logs/2024/01")]
+    assert ("logs/2024/02/02/", None) in paginator.requests
+
+    paginator = _StubPaginator(keys, "logs/2024/02/", OSError("listing failed"))
+    with pytest.raises(OSError, match="listing failed"):
+        _collect(_s3_source(monkeypatch, paginator, 2))
+
+
+def test_inventory_csv():
+    rows = [
+        [
+            "bucket",
+            "logs/a%20b.json",
+            "10",
+            "2024-01-01T00:00:00.000Z",
+            "etag-a",
+            "true",
+            "false",
+        ],
+        [
+            "bucket",
+            "logs/old.json",
+            "10",
+            "2024-01-01T00:00:00.000Z",
+            "etag-o",
+            "false",
+            "false",
+        ],
+        [
+            "bucket",
+            "logs/gone.json",
+            "",
+            "2024-01-01T00:00:00.000Z",
+            "",
+            "true",
+            "true",
+        ],
+        [
+            "bucket",
+            "logs/c%2Bd.json",
+            "20",
+            "2024-01-01T00:00:00.000Z",
+            "etag-c",
+            "true",
+            "false",
+        ],
+    ]
+    data = gzip.compress(
+        "".join(",".join(f'"{v}"' for v in r) + "\n" for r in rows).encode()
+    )
+    schema = [
+        "Bucket",
+        "Key",
+        "Size",
+        "LastModifiedDate",
+        "ETag",
+        "IsLatest",
+        "IsDeleteMarker",
+    ]
+    assert list(sources.INVENTORY_FORMATS["CSV"](data, schema)) == [
+        {"Key": "logs/a b.json", "Size": 10, "ETag": '"etag-a"'},
+        {"Key": "logs/c+d.json", "Size": 20, "ETag": '"etag-c"'},
+    ]
+
+
+def _s3log(path, **kwargs):
+    options = dict(
+        region=None,
+        access_key_id=None,
+        secret_access_key=None,
+        local=True,
+        inventory=None,
+        workers=0,
+        fetchers=2,
+        listers=1,
+        list_depth=0,
+        buffer=16,
+        split_size=0,
+        checkpoint=None,
+        cache=None,
+        cache_size=64,
+        object_cache=None,
+        object_cache_size=1024,
+        output=None,
+        output_format="ndjson",
+        output_compression="none",
+        since=None,
+        until=None,
+        key_time=None,
+        row_time=None,
+        batch_size=4096,
+        decoder="auto",
+        pool="subprocess",
+        transport="pipe",
+        order="listing",
+        in_process_below=4,
+        metrics=None,
+        shard=None,
+        shard_by="hash",
+        partial=None,
+        follow=False,
+        poll_interval=60,
+        plan_only=False,
+        plan_throughput=50,
+        progress=False,
+    )
+    options.update(kwargs)
+    return S3Log(path, "", "tests.s3log_script", **options)
+
+
+def test_s3log_local(tmp_path, capsys):
+    logs = tmp_path / "logs"
+    logs.mkdir()
+    (logs / "a.json").write_text("\n".join(json.dumps(r) for r in _records(30)))
+    (logs / "b.json.gz").write_bytes(
+        gzip.compress("\n".join(json.dumps(r) for r in _records(12)).encode())
+    )
+    checkpoint = str(tmp_path / "checkpoint.db")
+    metrics_file = tmp_path / "metrics.jsonl"
+
+    _s3log(str(logs), checkpoint=checkpoint, metrics=str(metrics_file)).run()
+    assert capsys.readouterr().out.splitlines()[-1] == "42"
+    final = json.loads(metrics_file.read_text().splitlines()[-1])
+    assert final["s3log_listed_objects_total"] == 2
+    assert final["s3log_processed_objects_total"] == 2
+    assert final["s3log_processed_lines_total"] == 42
+    assert final["s3log_objects_in_flight"] == 0
+    assert final['s3log_get_first_byte_seconds_bucket{le="+Inf"}'] == 2
+    assert 's3log_worker_busy_seconds_total{worker="main"}' in final
+    for transport in ["pipe", "shm"]:
+        _s3log(
+            str(logs),
+            workers=2,
+            in_process_below=0,
+            pool="forkserver",
+            transport=transport,
+        ).run()
+        assert capsys.readouterr().out.splitlines()[-1] == "42"
+    # everything recorded: nothing fetched again, same result
+    s3log = _s3log(str(logs), checkpoint=checkpoint)
+    s3log.run()
+    assert capsys.readouterr().out.splitlines()[-1] == "42"
+    assert _Checkpoint(checkpoint, str(logs), s3log._script_hash).count() == 2
+
+    (logs / "c.json").write_text("\n".join(json.dumps(r) for r in _records(5)))
+    _s3log(str(logs), checkpoint=checkpoint, plan_only=True).run()
+    assert capsys.readouterr().out.splitlines()[:2] == [
+        "Keys: 1",
+        "Size: {:.1f}{}B".format(*_unitize((logs / "c.json").stat().st_size)),
+    ]
+    # run differently, nothing is skipped
+    _s3log(str(logs), checkpoint=checkpoint, decoder="json", plan_only=True).run()
+    assert capsys.readouterr().out.splitlines()[0] == "Keys: 3"
+
+    cache = str(tmp_path / "cache.db")
+    _s3log(str(logs), cache=cache).run()
+    assert capsys.readouterr().out.splitlines()[-1] == "47"
+    (logs / "a.json").write_text("\n".join(json.dumps(r) for r in _records(20)))
+    _s3log(str(logs), cache=cache).run()
+    captured = capsys.readouterr()
+    assert captured.out.splitlines()[-1] == "37"
+    assert "Result cache: 2 hits, 1 stored" in captured.err
+
+
+def _rings():
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return set(glob.glob(os.path.join(directory, "s3log-*.ring")))
+
+
+def test_s3log_shm_rings_removed(tmp_path, capsys, monkeypatch):
+    logs = tmp_path / "logs"
+    logs.mkdir()
+    (logs / "a.json").write_text("\n".join(json.dumps(r) for r in _records(5)))
+    before = _rings()
+
+    def run():
+        return _s3log(
+            str(logs), workers=2, in_process_below=0, pool="forkserver", transport="shm"
+        ).run()
+
+    run()
+    assert capsys.readouterr().out.splitlines()[-1] == "5"
+    assert _rings() == before
+
+    async def failing_list(self, enqueue, in_window, start_after=None):
+        await asyncio.sleep(0.5)
+        raise OSError("listing failed")
+
+    with monkeypatch.context() as m:
+        m.setattr(sources.LocalSource, "list", failing_list)
+        with pytest.raises(OSError):
+            run()
+    assert _rings() == before
+
+    monkeypatch.setattr("gen3utils.s3log.s3log.PROTOCOL_VERSION", 99)
+    with pytest.raises(RuntimeError, match="protocol version 99"):
+        run()
+    assert _rings() == before
+
+
+def test_object_cache(tmp_path):
+    directory = str(tmp_path / "objects")
+    cache = _ObjectCache(directory, "bucket", 25)
+
+    def fetch(key, etag, data):
+        f = cache.writer(key, etag, len(data))
+        f.write(data)
+        cache.store(key, etag, f)
+
+    assert cache.lookup("a", '"1"') is None
+    assert cache.writer("a", None, 1) is None
+    assert cache.writer("a", '"1"', 26) is None
+    fetch("a", '"1"', b"a" * 10)
+    fetch("b", '"1"', b"b" * 10)
+    path = cache.lookup("a", '"1"')
+    assert open(path, "rb").read() == b"a" * 10
+    assert cache.lookup("a", '"2"') is None
+    # a is being read, so b goes
+    fetch("c", '"1"', b"c" * 10)
+    assert cache.lookup("b", '"1"') is None
+    cache.release(path)
+    fetch("d", '"1"', b"d" * 10)
+    assert cache.lookup("a", '"1"') is None
+    # an interrupted fetch leaves nothing
+    f = cache.writer("e", '"1"', 10)
+    f.write(b"e")
+    cache.discard(f)
+    cache.close()
+
+    cache = _ObjectCache(directory, "bucket", 25)
+    assert cache.lookup("d", '"1"') is not None
+    assert cache.lookup("c", '"1"') is not None
+    assert len([n for n in os.listdir(directory) if not n.startswith("index")]) == 2
+    cache.close()
+
+
+def test_shard():
+    assert _parse_shard("2/3") == (2, 3)
+    for value in ["3/3", "1", "-1/2", "a/b"]:
+        with pytest.raises(ValueError):
+            _parse_shard(value)
+
+    keys = [f"logs/{i}.json" for i in range(300)]
+    shards = [_key_shard(key, 3) for key in keys]
+    # stable: the same on every machine
+    assert shards == [_key_shard(key, 3) for key in keys]
+    assert all(count > 50 for count in collections.Counter(shards).values())
+
+    entries = [{"Key": key, "Size": (i * 37) % 100 + 1} for i, key in enumerate(keys)]
+    balanced = [_balanced_shard(entries, i, 3) for i in range(3)]
+    assert sorted(e["Key"] for shard in balanced for e in shard) == sorted(keys)
+    sizes = [sum(e["Size"] for e in shard) for shard in balanced]
+    assert max(sizes) - min(sizes) <= 100
+    assert [e["Key"] for e in balanced[0]] == sorted(e["Key"] for e in balanced[0])
+
+
+@pytest.mark.parametrize("shard_by", ["hash", "size"])
+def test_s3log_shard_merge(tmp_path, capsys, shard_by):
+    logs = tmp_path / "logs"
+    logs.mkdir()
+    for i in range(6):
+        (logs / f"{i}.json").write_text(
+            "\n".join(json.dumps(r) for r in _records(i + 1))
+        )
+    partials = [str(tmp_path / f"{i}.pickle") for i in range(2)]
+    for i, partial in enumerate(partials):
+        _s3log(str(logs), shard=f"{i}/2", shard_by=shard_by, partial=partial).run()
+    capsys.readouterr()
+    merge.merge("tests.s3log_script", partials)
+    assert capsys.readouterr().out == "21\n"
+
+    # planned like it is run: the shard's keys only
+    keys = []
+    for i in range(2):
+        _s3log(str(logs), shard=f"{i}/2", shard_by=shard_by, plan_only=True).run()
+        keys.append(int(capsys.readouterr().out.splitlines()[0].split()[-1]))
+    assert 0 < min(keys) and sum(keys) == 6
+
+    if shard_by == "size":
+        # machines polling at different times would balance different keys
+        with pytest.raises(ValueError):
+            _s3log(str(logs), shard="0/2", shard_by=shard_by, follow=True)
+    else:
+        _s3log(str(logs), shard="0/2", shard_by=shard_by, follow=True)
+
+    with pytest.raises(ValueError):
+        merge.merge(None, partials)
+    with pytest.raises(ValueError):
+        merge.merge("tests.s3log_script", [partials[0], str(logs)])
+
+
+def test_merge_manifests(tmp_path):
+    for i, lines in enumerate([3, 4]):
+        (tmp_path / str(i)).mkdir()
+        manifest = {
+            "format": "ndjson",
+            "compression": "gzip",
+            "objects": 1,
+            "lines": lines,
+            "shards": [{"path": "part-1-00000.ndjson.gz", "size": 10}],
+        }
+        (tmp_path / str(i) / "manifest.json").write_text(json.dumps(manifest))
+    merged = merge.merge_manifests([str(tmp_path / "0"), str(tmp_path / "1")])
+    assert merged["lines"] == 7
+    assert [s["path"] for s in merged["shards"]] == [
+        str(tmp_path / "0" / "part-1-00000.ndjson.gz"),
+        str(tmp_path / "1" / "part-1-00000.ndjson.gz"),
+    ]
+
+
+def test_s3log_small_buffer(tmp_path, capsys, monkeypatch):
+    monkeypatch.setattr(s3log_worker, "FILE_CHUNK_SIZE", 256)
+    logs = tmp_path / "logs"
+    logs.mkdir()
+    for i in range(40):
+        (logs / f"{i:02d}.json").write_text(
+            "\n".join(json.dumps(r) for r in _records(50))
+        )
+    s3log = _s3log(str(logs), fetchers=4)
+    # smaller than one object
+    s3log._buffer_size = 1000
+    s3log.run()
+    assert capsys.readouterr().out.splitlines()[-1] == "2000"
+    with pytest.raises(ValueError):
+        _s3log(str(logs), buffer=0)
+
+
+def test_s3log_buffer_below_in_process(tmp_path, capsys, monkeypatch):
+    monkeypatch.setattr("gen3utils.s3log.s3log.KEY_QUEUE_SIZE", 5)
+    logs = tmp_path / "logs"
+    logs.mkdir()
+    for i in range(40):
+        (logs / f"{i:02d}.json").write_text(
+            "\n".join(json.dumps(r) for r in _records(5))
+        )
+    s3log = _s3log(str(logs), workers=2, pool="forkserver")
+    # full long before --in-process-below worth of logs is listed
+    s3log._buffer_size = 1000
+    asyncio.run(asyncio.wait_for(s3log._run(), 30))
+    assert capsys.readouterr().out.splitlines()[-1] == "200"
+
+
+def test_s3log_split(tmp_path, capsys):
+    logs = tmp_path / "logs"
+    logs.mkdir()
+    (logs / "a.json").write_text("\n".join(json.dumps(r) for r in _records(50)))
+    # no line boundaries to cut at: read whole
+    (logs / "b.json").write_text("".join(json.dumps(r) for r in _records(30)))
+    # compressed without a suffix saying so
+    (logs / "c.log").write_bytes(
+        gzip.compress("\n".join(json.dumps(r) for r in _records(200)).encode())
+    )
+    s3log = _s3log(str(logs))
+    s3log._split_size = 500
+    s3log.run()
+    assert capsys.readouterr().out.splitlines()[-1] == "280"
+    # nothing to record the whole objects in
+    assert not s3log._split_progress
+
+    checkpoint = str(tmp_path / "checkpoint.db")
+    s3log = _s3log(str(logs), checkpoint=checkpoint)
+    s3log._split_size = 500
+    s3log.run()
+    assert capsys.readouterr().out.splitlines()[-1] == "280"
+    assert not s3log._split_progress
+    assert _Checkpoint(checkpoint, str(logs), s3log._script_hash).count() == 3
+
+    # a failing range leaves its object unrecorded and forgotten
+    (logs / "a.json").write_text(
+        "\n".join(json.dumps(r) for r in _records(49)) + '\n{"raise": "bad"}'
+    )
+    s3log = _s3log(str(logs), checkpoint=checkpoint)
+    s3log._split_size = 500
+    assert s3log.run() == 1
+    assert "Failed: 1 objects, a.json" in capsys.readouterr().err
+    assert not s3log._split_progress
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_s3log_failed(tmp_path, capsys, workers):
+    logs = tmp_path / "logs"
+    logs.mkdir()
+    (logs / "a.json").write_text("\n".join(json.dumps(r) for r in _records(5)))
+    (logs / "b.json").write_text('{"a": 1}\n{"raise": "bad"}\n{"a": 2}\n')
+    checkpoint = str(tmp_path / "checkpoint.db")
+    s3log = _s3log(
+        str(logs),
+        checkpoint=checkpoint,
+        workers=workers,
+        in_process_below=0,
+        pool="forkserver",
+    )
+    assert s3log.run() == 1
+    captured = capsys.readouterr()
+    assert captured.out.splitlines()[-1] == "5"
+    assert "Failed processing key: b.json" in captured.err
+    assert "ValueError: bad" in captured.err
+    assert "Failed: 1 objects, b.json" in captured.err
+    # retried by the next run
+    assert _Checkpoint(checkpoint, str(logs), s3log._script_hash).count() == 1
+
+
+def test_s3log_worker_exits(tmp_path):
+    logs = tmp_path / "logs"
+    logs.mkdir()
+    (logs / "a.json").write_text('{"a": 1}\n{"exit": 3}\n')
+    # restarted once, then the script is to blame
+    with pytest.raises(asyncio.IncompleteReadError):
+        _s3log(str(logs), workers=1, in_process_below=0, pool="forkserver").run()
+
+
+def test_s3log_follow(tmp_path, capsys):
+    logs = tmp_path / "logs"
+    logs.mkdir()
+    checkpoint = str(tmp_path / "checkpoint.db")
+
+    async def follow(steps):
+        """
+        Write the logs of each step once the previous one printed its window,
+        returning the windows printed.
+        """
+        s3log = _s3log(
+            str(logs), checkpoint=checkpoint, follow=True, poll_interval=0.01
+        )
+        run = asyncio.ensure_future(s3log._run())
+        windows = []
+        for step in steps:
+            for name, count in step:
+                (logs / name).write_text(
+                    "\n".join(json.dumps(r) for r in _records(count))
+                )
+            for _ in range(100):
+                await asyncio.sleep(0.01)
+                out = capsys.readouterr().out
+                if out:
+                    windows.extend(out.splitlines())
+                    break
+        run.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await run
+        return windows
+
+    (logs / "2024-01-01.json").write_text(json.dumps({"a": 1}))
+    assert asyncio.run(follow([[], [("2024-01-02.json", 5)]])) == ["1", "5"]
+    # resumes after the last key listed; keys sorting before it are missed
+    steps = [[("2024-01-03.json", 7)], [("2023-12-31.json", 13)]]
+    assert asyncio.run(follow(steps)) == ["7"]
+    # later polls may be larger than the first: never decided from its size
+    assert _s3log(str(logs), workers=2, follow=True)._in_process_below == 0
+
+
+def test_metrics():
+    assert metrics.parse_target("9100") == ("http", "127.0.0.1", 9100)
+    assert metrics.parse_target("0.0.0.0:9100") == ("http", "0.0.0.0", 9100)
+    assert metrics.parse_target("run/metrics.jsonl") == ("file", "run/metrics.jsonl")
+
+    latency = metrics.Histogram((0.1, 1))
+    for value in [0.05, 0.1, 0.5, 2]:
+        latency.observe(value)
+    samples = [
+        ("s3log_lines_total", "counter", "Rows.", 42),
+        ("s3log_requests_total", "counter", "Requests.", [({"op": 'a"b'}, 3)]),
+        ("s3log_get_seconds", "histogram", "GET latency.", latency),
+    ]
+    assert metrics.prometheus(samples).splitlines() == [
+        "# HELP s3log_lines_total Rows.",
+        "# TYPE s3log_lines_total counter",
+        "s3log_lines_total 42",
+        "# HELP s3log_requests_total Requests.",
+        "# TYPE s3log_requests_total counter",
+        's3log_requests_total{op="a\\"b"} 3',
+        "# HELP s3log_get_seconds GET latency.",
+        "# TYPE s3log_get_seconds histogram",
+        's3log_get_seconds_bucket{le="0.1"} 2',
+        's3log_get_seconds_bucket{le="1"} 3',
+        's3log_get_seconds_bucket{le="+Inf"} 4',
+        "s3log_get_seconds_sum 2.65",
+        "s3log_get_seconds_count 4",
+    ]
+
+    async def scrape():
+        server = await metrics.serve("127.0.0.1", 0, lambda: samples)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        response = await reader.read()
+        writer.close()
+        server.close()
+        return response
+
+    status, body = asyncio.run(scrape()).split(b"\r\n\r\n", 1)
+    assert status.startswith(b"HTTP/1.1 200 OK")
+    assert body.decode() == metrics.prometheus(samples)